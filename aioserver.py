@@ -0,0 +1,251 @@
+# Asyncio webhook server, an alternative entry point to the Flask app:
+#
+#   python aioserver.py [--host HOST] [--port PORT]
+#
+# Updates are run by the same code as webhook_handler, in their lanes since
+# the Datastore client is synchronous, so the event loop only waits on the
+# network. Each update in flight holds a lane thread while it waits on the
+# Datastore: AIO_LANE_WORKERS, larger than the LANE_WORKERS of the Flask
+# app, is the number of updates handled at the same time. Messages that have a Bot API JSON form are sent over aiohttp from
+# the event loop, uploads and rendering run in the thread pool. All messages,
+# including computer moves and evaluations, go through the same sender.
+
+from shared import app, bot, dispatcher, scheduler
+
+import argparse
+import asyncio
+import hmac
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+from aiohttp import web
+import telegram
+import constants
+import dispatch
+import metrics
+from cache import LRUCache
+from main import run_update, submit_update
+
+
+API_URL = "https://api.telegram.org/bot{}/{}"
+
+
+class AsyncSender(object):
+
+    # Same interface as the dispatchers in dispatch.py. Jobs submitted from
+    # other threads are handed to the event loop. Each chat is served in
+    # order, under the same rate limits.
+
+    def __init__(self, executor, global_rate=30, chat_rate=1, chat_burst=3, max_retries=3):
+
+        self.executor = executor
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+
+        self.global_bucket = dispatch.TokenBucket(global_rate, global_rate)
+        self.chat_buckets = LRUCache(max_items=10000)
+
+        self.http = None
+        self.loop = None
+        self._jobs = {}
+
+    async def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+
+    async def stop(self):
+        await self.http.close()
+
+    def submit_all(self, jobs):
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+
+        if in_loop:
+            self._submit_all(jobs)
+        else:
+            self.loop.call_soon_threadsafe(self._submit_all, list(jobs))
+
+    def _submit_all(self, jobs):
+        for chat_id, job in jobs:
+            if chat_id in self._jobs:
+                self._jobs[chat_id].append(job)
+            else:
+                self._jobs[chat_id] = deque([job])
+                asyncio.ensure_future(self._serve(chat_id))
+
+    def pending(self, chat_id):
+        return len(self._jobs.get(chat_id, ()))
+
+    def join(self, timeout=None):
+        return True
+
+    async def _serve(self, chat_id):
+
+        jobs = self._jobs[chat_id]
+        loop = asyncio.get_event_loop()
+
+        while jobs:
+            job = jobs[0]
+            await self._throttle(chat_id)
+
+            if job.webhook:
+                delay = await self._call(job)
+            else:
+                delay = await loop.run_in_executor(self.executor, dispatch.run_job, job, self.max_retries)
+
+            if delay is not None:
+                await asyncio.sleep(delay)
+            else:
+                jobs.popleft()
+
+        del self._jobs[chat_id]
+
+    async def _throttle(self, chat_id):
+
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = dispatch.TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets.put(chat_id, bucket)
+
+        while True:
+            now = time.monotonic()
+            delay = max(bucket.delay(now), self.global_bucket.delay(now))
+            if delay <= 0:
+                bucket.take()
+                self.global_bucket.take()
+                return
+            await asyncio.sleep(delay)
+
+    async def _call(self, job):
+        # Sends the JSON form of the job, returns the seconds to wait before
+        # retrying it or None when the job is done, as dispatch.run_job
+
+        job.attempts += 1
+        payload = dict(job.webhook)
+        method = payload.pop("method")
+        start = time.perf_counter()
+
+        try:
+            async with self.http.post(API_URL.format(app.config['BOT_TOKEN'], method), json=payload) as response:
+                result = await response.json()
+        except asyncio.TimeoutError:
+            metrics.telegram_calls.inc(method=method, result="TimedOut")
+            if dispatch.is_idempotent(job) and job.attempts <= self.max_retries:
+                logging.warning("Telegram timed out, retrying")
+                return 2**(job.attempts - 1)
+            logging.error("Telegram timed out, the call may have gone through")
+            job.future.set_exception(telegram.error.TimedOut())
+            return None
+        except (aiohttp.ClientError, ValueError) as e:
+            metrics.telegram_calls.inc(method=method, result="NetworkError")
+            if job.attempts <= self.max_retries:
+                logging.warning("Network error (%s), retrying", e)
+                return 2**(job.attempts - 1)
+            logging.error("Unable to send to Telegram: %s", e)
+            job.future.set_exception(telegram.error.NetworkError(str(e)))
+            return None
+        finally:
+            metrics.telegram_latency.observe(time.perf_counter() - start, method=method)
+
+        if result.get("ok"):
+            metrics.telegram_calls.inc(method=method, result="ok")
+            job.future.set_result(telegram.Message.de_json(result.get("result"), bot.get()))
+            return None
+
+        retry_after = result.get("parameters", {}).get("retry_after")
+        if retry_after:
+            # Flood control (HTTP 429)
+            metrics.telegram_calls.inc(method=method, result="RetryAfter")
+            logging.warning("Flood control exceeded, retrying in %d seconds", retry_after)
+            if job.attempts <= self.max_retries:
+                return retry_after
+            job.future.set_exception(telegram.error.RetryAfter(retry_after))
+        else:
+            metrics.telegram_calls.inc(method=method, result="BadRequest")
+            logging.error("Telegram rejected the request: %s", result.get("description"))
+            job.future.set_exception(telegram.error.BadRequest(result.get("description", "")))
+
+        return None
+
+
+async def webhook_handler(request):
+
+    update = telegram.Update.de_json(await request.json(), bot)
+
+    processed = await asyncio.wrap_future(submit_update(update, run_update))
+
+    if processed:
+        # The last message to the user can be the reply to the webhook
+        outbox, chat_id = processed
+        reply = outbox.release(dispatcher, chat_id)
+        if reply:
+            return web.json_response(reply)
+
+    return web.Response(text=constants.RESPONSE_OK)
+
+
+async def metrics_handler(request):
+
+    # Same basic auth as the Flask app
+    password = app.config.get('ADMIN_PASS')
+    try:
+        auth = aiohttp.BasicAuth.decode(request.headers.get("Authorization", ""))
+    except ValueError:
+        auth = None
+    if not password or not auth or not hmac.compare_digest(auth.password.encode(), password.encode()):
+        return web.Response(text=constants.RESPONSE_FAIL, status=401,
+                            headers={"WWW-Authenticate": 'Basic realm="Chess Duel Bot"'})
+
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+
+def create_app():
+
+    # Sized before the first update starts the pool of the lanes
+    scheduler.workers = app.config.get('AIO_LANE_WORKERS', 256)
+
+    executor = ThreadPoolExecutor(max_workers=app.config.get('AIO_WORKERS', 32))
+    sender = AsyncSender(executor,
+                         global_rate=app.config.get('SEND_GLOBAL_RATE', 30),
+                         chat_rate=app.config.get('SEND_CHAT_RATE', 1),
+                         chat_burst=app.config.get('SEND_CHAT_BURST', 3),
+                         max_retries=app.config.get('SEND_MAX_RETRIES', 3))
+
+    previous = dispatcher.target
+
+    web_app = web.Application()
+    web_app["executor"] = executor
+    web_app["sender"] = sender
+
+    web_app.router.add_post(app.config['BOT_HOOK'], webhook_handler)
+    web_app.router.add_get('/metrics', metrics_handler)
+
+    async def on_startup(web_app):
+        await sender.start()
+        dispatcher.install(sender)
+
+    async def on_cleanup(web_app):
+        dispatcher.install(previous)
+        await sender.stop()
+        executor.shutdown(wait=False)
+
+    web_app.on_startup.append(on_startup)
+    web_app.on_cleanup.append(on_cleanup)
+
+    return web_app
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8080)))
+    args = parser.parse_args()
+
+    web.run_app(create_app(), host=args.host, port=args.port)
@@ -0,0 +1,171 @@
+import struct
+import zlib
+from collections import namedtuple
+from datetime import datetime
+from enum import IntEnum
+from google.cloud import ndb
+import history
+import session
+
+
+class Termination(IntEnum):
+    UNKNOWN = 0
+    CHECKMATE = 1
+    STALEMATE = 2
+    REPETITION = 3
+    FIVEFOLD = 4
+    FIFTY = 5
+    SEVENTY_FIVE = 6
+    RESIGNED = 7
+    TIMEOUT = 8
+
+
+DRAWS = (Termination.STALEMATE, Termination.REPETITION, Termination.FIVEFOLD,
+         Termination.FIFTY, Termination.SEVENTY_FIVE)
+
+# Results as in PGN, by stored code
+RESULTS = ("*", "1-0", "0-1", "1/2-1/2")
+
+# A game is stored as a fixed header (match id, white id, black id, creation
+# and end timestamps, timeout, result code, termination) followed by white
+# name, black name, start FEN and packed moves, each prefixed by its length
+HEADER = struct.Struct(">qqqIIIBB")
+FIELD = struct.Struct(">H")
+
+# Compressed size after which a new batch is started, well below the
+# Datastore entity limit
+MAX_BATCH_BYTES = 512*1024
+
+
+class ArchivedGame(namedtuple("ArchivedGame", [
+        "match_id", "white_id", "black_id", "creation_date", "end_date", "timeout",
+        "result", "termination", "white_name", "black_name", "start_fen", "moves"])):
+
+    def get_moves(self):
+        return history.unpack(self.moves)
+
+
+def _timestamp(date):
+    return int(date.timestamp()) if date else 0
+
+
+def _date(timestamp):
+    return datetime.fromtimestamp(timestamp) if timestamp else None
+
+
+def pack(game):
+
+    record = HEADER.pack(game.match_id, game.white_id or 0, game.black_id or 0,
+                         _timestamp(game.creation_date), _timestamp(game.end_date), game.timeout or 0,
+                         RESULTS.index(game.result), game.termination)
+
+    for field in ((game.white_name or "").encode(), (game.black_name or "").encode(),
+                  (game.start_fen or "").encode(), game.moves or b""):
+        record += FIELD.pack(len(field)) + field
+
+    return record
+
+
+def unpack(data):
+
+    offset = 0
+    while offset < len(data):
+        match_id, white_id, black_id, creation, end, timeout, result, termination = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+
+        fields = []
+        for _ in range(4):
+            (size,) = FIELD.unpack_from(data, offset)
+            offset += FIELD.size
+            fields.append(data[offset:offset + size])
+            offset += size
+
+        white_name, black_name, start_fen, moves = fields
+        yield ArchivedGame(match_id, white_id, black_id, _date(creation), _date(end), timeout,
+                           RESULTS[result], Termination(termination),
+                           white_name.decode(), black_name.decode(), start_fen.decode() or None, moves)
+
+
+class ArchiveBatch(ndb.Model):
+
+    # Finished games of a user in a month, keyed by "<user id>:<month>:<part>"
+    user_id = ndb.IntegerProperty()
+    month = ndb.StringProperty()
+    part = ndb.IntegerProperty(default=0)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    data = ndb.BlobProperty(default=b"")
+    update_date = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    def get_games(self):
+        if not self.data:
+            return []
+        return list(unpack(zlib.decompress(self.data)))
+
+    def add(self, record):
+        raw = zlib.decompress(self.data) if self.data else b""
+        self.data = zlib.compress(raw + record, 9)
+        self.count += 1
+
+
+def get_batch(user_id, month):
+
+    # Last batch of the month with room left
+    part = 0
+    while True:
+        batch = session.get(ArchiveBatch, "{}:{}:{}".format(user_id, month, part))
+        if not batch:
+            return ArchiveBatch(id="{}:{}:{}".format(user_id, month, part), user_id=user_id, month=month, part=part)
+        if len(batch.data or b"") < MAX_BATCH_BYTES:
+            return batch
+        part += 1
+
+
+def archive_match(match, players, termination, winner=None):
+
+    # Stores the match in the archive of both players and deletes it
+    names = {player.key.id(): player.username for player in players if player}
+    transient = {player.key.id() for player in players if player and getattr(player, "transient", False)}
+
+    if termination in DRAWS:
+        result = "1/2-1/2"
+    elif winner and winner.key.id() == match.white_id:
+        result = "1-0"
+    elif winner and winner.key.id() == match.black_id:
+        result = "0-1"
+    else:
+        result = "*"
+
+    end_date = datetime.now()
+    game = ArchivedGame(match.key.id(), match.white_id, match.black_id, match.creation_date, end_date,
+                        match.timeout, result, termination, names.get(match.white_id), names.get(match.black_id),
+                        match.start_fen, match.moves)
+    record = pack(game)
+
+    month = end_date.strftime("%Y-%m")
+    user_ids = sorted({user_id for user_id in (match.white_id, match.black_id) if user_id} - transient)
+
+    def store():
+        # Batches are shared by all the games of a user, read and written in
+        # a transaction so that concurrent games don't overwrite each other
+        for user_id in user_ids:
+            batch = get_batch(user_id, month)
+            batch.add(record)
+            session.save(batch)
+
+        session.delete(match.key)
+
+    session.transaction(store)
+
+
+def user_games(user_id, limit=20):
+
+    # Most recent finished games of a user, newest first
+    query = ArchiveBatch.query(ArchiveBatch.user_id == user_id).order(-ArchiveBatch.month, -ArchiveBatch.part)
+
+    games = []
+    for batch in query.iter():
+        games.extend(reversed(batch.get_games()))
+        if len(games) >= limit:
+            break
+
+    return games[:limit]
@@ -0,0 +1,595 @@
+# In-process stand-ins for Telegram and Datastore used by the load test.
+#
+# install() must run before the bot modules are imported: it registers an
+# in-memory google.cloud.ndb (and a silent google.cloud.logging) in
+# sys.modules and swaps telegram.Bot with FakeBot.
+
+import base64
+import copy
+import itertools
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+import telegram
+from google.api_core import exceptions
+
+
+class CallCounter(object):
+
+    def __init__(self):
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, name, count=1):
+        with self.lock:
+            self.counts[name] += count
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+
+datastore_calls = CallCounter()
+api_calls = CallCounter()
+
+
+##################################################
+#                  TELEGRAM
+##################################################
+
+class FakeBot(object):
+
+    latency = 0
+
+    def __init__(self, token=None, **kwargs):
+        self.token = token
+        self.bot = telegram.User(1, "Chess Duel Bot", True, username="ChessDuelBot")
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    def _call(self, method):
+        api_calls.add(method)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _message(self, chat_id, **kwargs):
+        return telegram.Message(next(self._message_ids), self.bot, datetime.now(),
+                                telegram.Chat(chat_id, telegram.Chat.PRIVATE), bot=self, **kwargs)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._call("sendMessage")
+        return self._message(chat_id, text=text)
+
+    def send_photo(self, chat_id, photo, caption=None, **kwargs):
+        self._call("sendPhoto")
+        if hasattr(photo, "read"):
+            file_id = "photo-{}".format(next(self._file_ids))
+            size = len(photo.read())
+        else:
+            file_id = photo
+            size = None
+        return self._message(chat_id, caption=caption, photo=[telegram.PhotoSize(file_id, 400, 400, file_size=size)])
+
+    def send_document(self, chat_id, document, filename=None, caption=None, **kwargs):
+        self._call("sendDocument")
+        return self._message(chat_id, caption=caption)
+
+    def delete_message(self, chat_id, message_id, **kwargs):
+        self._call("deleteMessage")
+        return True
+
+    def set_webhook(self, url=None, **kwargs):
+        self._call("setWebhook")
+        return True
+
+    def get_updates(self, offset=None, limit=100, timeout=0, **kwargs):
+        self._call("getUpdates")
+        return []
+
+    def delete_webhook(self, **kwargs):
+        self._call("deleteWebhook")
+        return True
+
+    sendMessage = send_message
+    sendPhoto = send_photo
+    deleteMessage = delete_message
+    setWebhook = set_webhook
+
+
+##################################################
+#                  DATASTORE
+##################################################
+
+_store = {}
+_store_lock = threading.RLock()
+_ids = itertools.count(1)
+_kinds = {}
+
+# Times each entity was written, to detect conflicts at commit
+_versions = {}
+
+# Context and transaction of the current thread
+_local = threading.local()
+
+# Errors raised by the next commits instead of committing, to test retries
+fail_commits = []
+
+
+class _Transaction(object):
+
+    def __init__(self):
+        # Version of the entities read, values to write (None deletes)
+        self.reads = {}
+        self.writes = {}
+
+
+class Key(object):
+
+    def __init__(self, kind, id):
+        if isinstance(kind, type):
+            kind = kind.__name__
+        self._kind = kind
+        self._id = id
+
+    def kind(self):
+        return self._kind
+
+    def id(self):
+        return self._id
+
+    def _pair(self):
+        return (self._kind, self._id)
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and self._pair() == other._pair()
+
+    def __hash__(self):
+        return hash(self._pair())
+
+    def __repr__(self):
+        return "Key({!r}, {!r})".format(self._kind, self._id)
+
+    def get(self, use_cache=None, **kwargs):
+        cache = _cache(use_cache)
+        if cache is not None and self in cache:
+            return cache[self]
+        datastore_calls.add("get")
+        entity = _load(self)
+        if cache is not None:
+            cache[self] = entity
+        return entity
+
+    def delete(self, use_cache=None, **kwargs):
+        datastore_calls.add("delete")
+        _write(self._pair(), None)
+        _cache_put(self, None, use_cache)
+
+
+def _cache(use_cache=None):
+    # Cache of the current context, as google.cloud.ndb: one instance per key,
+    # shared with the transactions started in the context
+    context = getattr(_local, "context", None)
+    if context is None or use_cache is False:
+        return None
+    return context.cache
+
+
+def _cache_put(key, entity, use_cache=None):
+    cache = _cache(use_cache)
+    if cache is not None:
+        cache[key] = entity
+
+
+def _load(key):
+    with _store_lock:
+        values = _store.get(key._pair())
+        txn = getattr(_local, "transaction", None)
+        if txn is not None:
+            txn.reads.setdefault(key._pair(), _versions.get(key._pair(), 0))
+        if values is None:
+            return None
+        entity = _kinds[key.kind()]()
+        entity._values = copy.deepcopy(values)
+        entity.key = key
+        return entity
+
+
+def _store_entity(entity):
+    if entity.key is None:
+        entity.key = Key(type(entity), next(_ids))
+    values = copy.deepcopy(entity._values)
+    for name, prop in entity._properties.items():
+        if isinstance(prop, ComputedProperty):
+            values[name] = prop.__get__(entity, type(entity))
+        elif name not in values:
+            values[name] = prop._default()
+    _write(entity.key._pair(), values)
+    return entity.key
+
+
+def _write(pair, values):
+    # Buffered until the commit in a transaction
+    txn = getattr(_local, "transaction", None)
+    if txn is not None:
+        txn.writes[pair] = values
+        return
+
+    with _store_lock:
+        if values is None:
+            _store.pop(pair, None)
+        else:
+            _store[pair] = values
+        _versions[pair] = _versions.get(pair, 0) + 1
+
+
+class Filter(object):
+
+    OPERATORS = {
+        "==": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+    }
+
+    def __init__(self, name, op, value):
+        self.name = name
+        self.op = op
+        self.value = value
+
+    def match(self, values):
+        value = values.get(self.name)
+        if isinstance(value, list):
+            return any(self._match(v) for v in value)
+        return self._match(value)
+
+    def _match(self, value):
+        if self.op != "==" and (value is None or self.value is None):
+            return False
+        return self.OPERATORS[self.op](value, self.value)
+
+
+class Property(object):
+
+    def __init__(self, name=None, default=None, repeated=False, indexed=True, auto_now=False, auto_now_add=False, **kwargs):
+        self._name = name
+        self._default_value = default
+        self._repeated = repeated
+        self._auto_now = auto_now or auto_now_add
+
+    def __set_name__(self, owner, name):
+        self._name = self._name or name
+
+    def _default(self):
+        if self._repeated:
+            return []
+        if self._auto_now:
+            return datetime.now()
+        return copy.copy(self._default_value)
+
+    def __get__(self, entity, owner):
+        if entity is None:
+            return self
+        if self._name not in entity._values:
+            entity._values[self._name] = self._default()
+        return entity._values[self._name]
+
+    def __set__(self, entity, value):
+        entity._values[self._name] = value
+
+    def _filter(self, op, value):
+        return Filter(self._name, op, value)
+
+    def __eq__(self, value):
+        return self._filter("==", value)
+
+    def __ne__(self, value):
+        return self._filter("!=", value)
+
+    def __lt__(self, value):
+        return self._filter("<", value)
+
+    def __le__(self, value):
+        return self._filter("<=", value)
+
+    def __gt__(self, value):
+        return self._filter(">", value)
+
+    def __ge__(self, value):
+        return self._filter(">=", value)
+
+    def __neg__(self):
+        return Order(self._name, True)
+
+    __hash__ = object.__hash__
+
+
+class Order(object):
+
+    def __init__(self, name, descending=False):
+        self.name = name
+        self.descending = descending
+
+
+class ComputedProperty(Property):
+
+    def __init__(self, func, **kwargs):
+        super(ComputedProperty, self).__init__(**kwargs)
+        self._func = func
+
+    def __get__(self, entity, owner):
+        if entity is None:
+            return self
+        return self._func(entity)
+
+    def __set__(self, entity, value):
+        raise AttributeError("ComputedProperty is read-only")
+
+
+class MetaModel(type):
+
+    def __init__(cls, name, bases, attrs):
+        super(MetaModel, cls).__init__(name, bases, attrs)
+        cls._properties = {}
+        for base in reversed(cls.__mro__):
+            for attr, value in vars(base).items():
+                if isinstance(value, Property):
+                    cls._properties[value._name] = value
+        _kinds[name] = cls
+
+
+class Model(metaclass=MetaModel):
+
+    def __init__(self, id=None, key=None, **kwargs):
+        self._values = {}
+        self.key = key or (Key(type(self), id) if id is not None else None)
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def put(self, use_cache=None, **kwargs):
+        datastore_calls.add("put")
+        key = _store_entity(self)
+        _cache_put(key, self, use_cache)
+        return key
+
+    def populate(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def to_dict(self, exclude=None):
+        return {name: getattr(self, name) for name in self._properties if not exclude or name not in exclude}
+
+    @classmethod
+    def get_by_id(cls, id, **kwargs):
+        return Key(cls, id).get(**kwargs)
+
+    @classmethod
+    def query(cls, *filters):
+        return Query(cls.__name__, filters)
+
+
+class Cursor(object):
+
+    def __init__(self, urlsafe=None, last=None):
+        if urlsafe is not None:
+            if isinstance(urlsafe, str):
+                urlsafe = urlsafe.encode()
+            kind, _, id = base64.urlsafe_b64decode(urlsafe).decode().partition(":")
+            last = (kind, int(id) if id.lstrip("-").isdigit() else id)
+        self.last = last
+
+    def urlsafe(self):
+        return base64.urlsafe_b64encode("{}:{}".format(*self.last).encode())
+
+
+def _sort_key(pair):
+    return (not isinstance(pair[1], int), str(pair[1]) if not isinstance(pair[1], int) else pair[1])
+
+
+class Query(object):
+
+    def __init__(self, kind, filters, orders=()):
+        self.kind = kind
+        self.filters = filters
+        self.orders = orders
+
+    def order(self, *orders):
+        orders = [o if isinstance(o, Order) else Order(o._name) for o in orders]
+        return Query(self.kind, self.filters, self.orders + tuple(orders))
+
+    def _results(self):
+        with _store_lock:
+            rows = [(pair, values) for pair, values in _store.items()
+                    if pair[0] == self.kind and all(f.match(values) for f in self.filters)]
+        rows.sort(key=lambda row: _sort_key(row[0]))
+        for order in reversed(self.orders):
+            rows.sort(key=lambda row: row[1].get(order.name), reverse=order.descending)
+        return [pair for pair, values in rows]
+
+    def _build(self, pairs, keys_only):
+        keys = [Key(*pair) for pair in pairs]
+        if keys_only:
+            return keys
+        return [entity for entity in (_load(key) for key in keys) if entity]
+
+    def fetch(self, limit=None, keys_only=False, **kwargs):
+        datastore_calls.add("query")
+        return self._build(self._results()[:limit], keys_only)
+
+    def fetch_page(self, page_size, keys_only=False, start_cursor=None, **kwargs):
+        datastore_calls.add("query")
+        pairs = self._results()
+        if start_cursor is not None:
+            pairs = [pair for pair in pairs if _sort_key(pair) > _sort_key(start_cursor.last)]
+        page = pairs[:page_size]
+        cursor = Cursor(last=page[-1]) if page else start_cursor
+        return self._build(page, keys_only), cursor, len(pairs) > page_size
+
+    def iter(self, keys_only=False, **kwargs):
+        return iter(self.fetch(keys_only=keys_only))
+
+    __iter__ = iter
+
+
+def get_multi(keys, use_cache=None, **kwargs):
+    cache = _cache(use_cache)
+    missing = [key for key in keys if cache is None or key not in cache]
+    if missing:
+        datastore_calls.add("get_multi")
+    loaded = {key: _load(key) for key in missing}
+    if cache is not None:
+        cache.update(loaded)
+        return [cache[key] for key in keys]
+    return [loaded[key] for key in keys]
+
+
+def put_multi(entities, use_cache=None, **kwargs):
+    datastore_calls.add("put_multi")
+    keys = [_store_entity(entity) for entity in entities]
+    for key, entity in zip(keys, entities):
+        _cache_put(key, entity, use_cache)
+    return keys
+
+
+def delete_multi(keys, use_cache=None, **kwargs):
+    datastore_calls.add("delete_multi")
+    for key in keys:
+        _write(key._pair(), None)
+        _cache_put(key, None, use_cache)
+
+
+def transaction(callback, retries=3, **kwargs):
+    # Optimistic like Datastore: the commit fails with Aborted if an entity
+    # read in the transaction was written since. Transient errors run the
+    # callback again, as google.cloud.ndb does.
+    if in_transaction():
+        raise NotImplementedError("Can't start a transaction during a transaction.")
+
+    attempt = 0
+    while True:
+        attempt += 1
+        datastore_calls.add("transaction")
+
+        txn = _local.transaction = _Transaction()
+        try:
+            result = callback()
+        finally:
+            _local.transaction = None
+
+        try:
+            _commit(txn)
+        except (exceptions.ServiceUnavailable, exceptions.InternalServerError):
+            if attempt > retries:
+                raise
+            continue
+
+        return result
+
+
+def _commit(txn):
+    with _store_lock:
+        if fail_commits:
+            raise fail_commits.pop(0)
+
+        for pair, version in txn.reads.items():
+            if _versions.get(pair, 0) != version:
+                raise exceptions.Aborted("too much contention on these datastore entities")
+
+        for pair, values in txn.writes.items():
+            if values is None:
+                _store.pop(pair, None)
+            else:
+                _store[pair] = values
+            _versions[pair] = _versions.get(pair, 0) + 1
+
+
+def in_transaction():
+    return getattr(_local, "transaction", None) is not None
+
+
+class ContextError(Exception):
+    pass
+
+
+class Context(object):
+
+    def __init__(self):
+        self.cache = {}
+
+    def clear_cache(self):
+        self.cache.clear()
+
+
+def get_context():
+    context = getattr(_local, "context", None)
+    if context is None:
+        raise ContextError("No current context.")
+    return context
+
+
+class Client(object):
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @contextmanager
+    def context(self, **kwargs):
+        # A new context each time, its cache is merged into the enclosing one
+        # on exit
+        previous = getattr(_local, "context", None)
+        context = _local.context = Context()
+        try:
+            yield context
+        finally:
+            if previous is not None:
+                previous.cache.update(context.cache)
+            _local.context = previous
+
+
+def reset():
+    with _store_lock:
+        _store.clear()
+        _versions.clear()
+    del fail_commits[:]
+    datastore_calls.reset()
+    api_calls.reset()
+
+
+def _ndb_module():
+
+    ndb = types.ModuleType("google.cloud.ndb")
+
+    for name in ("Key", "Model", "Property", "ComputedProperty", "Cursor", "Query", "Client",
+                 "get_multi", "put_multi", "delete_multi", "transaction", "in_transaction", "get_context"):
+        setattr(ndb, name, globals()[name])
+
+    for name in ("StringProperty", "TextProperty", "IntegerProperty", "FloatProperty", "BooleanProperty",
+                 "DateTimeProperty", "BlobProperty", "JsonProperty", "PickleProperty"):
+        setattr(ndb, name, type(name, (Property,), {}))
+
+    return ndb
+
+
+def install():
+
+    google = sys.modules.setdefault("google", types.ModuleType("google"))
+    cloud = types.ModuleType("google.cloud")
+    google.cloud = cloud
+
+    ndb = _ndb_module()
+    cloud.ndb = ndb
+
+    logging_module = types.ModuleType("google.cloud.logging")
+    logging_module.Client = type("Client", (object,), {"setup_logging": lambda self, *args, **kwargs: None})
+    cloud.logging = logging_module
+
+    sys.modules["google.cloud"] = cloud
+    sys.modules["google.cloud.ndb"] = ndb
+    sys.modules["google.cloud.logging"] = logging_module
+
+    telegram.Bot = FakeBot
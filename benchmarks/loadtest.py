@@ -0,0 +1,269 @@
+# Replays synthetic Telegram updates against webhook_handler in-process, with
+# a fake Bot and an in-memory Datastore (see benchmarks/fakes.py).
+#
+#   python -m benchmarks.loadtest [--pairs N] [--moves N] [--concurrency N]
+#
+# Each pair of users goes through /new, accept, a random game with move
+# previews, /board, /info and chat. Latencies are grouped by the command
+# class that handled each update.
+
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks import fakes
+
+
+HOOK = "/hook"
+
+CONFIG = """\
+BOT_TOKEN = "0:fake"
+BOT_HOOK = "{hook}"
+BOT_HOST = "localhost"
+USER_TIMEOUT = 365
+ADMIN_PASS = "admin"
+ASYNC_SEND = {async_send}
+RENDERER = "{renderer}"
+"""
+
+
+class Recorder(object):
+
+    # Updates run in lanes (see lanes.py), so the label is taken in the lane
+    # thread and the latency in the client thread
+
+    def __init__(self):
+        self.local = threading.local()
+        self.labels = {}
+        self.latencies = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def label(self, name):
+        # The first command run by an update names it
+        if getattr(self.local, "label", None) is None:
+            self.local.label = name
+
+    def begin_update(self):
+        self.local.label = None
+
+    def end_update(self, update_id):
+        with self.lock:
+            self.labels[update_id] = self.local.label
+
+    def start(self):
+        self.local.start = time.perf_counter()
+
+    def stop(self, update_id):
+        elapsed = time.perf_counter() - self.local.start
+        with self.lock:
+            self.latencies[self.labels.pop(update_id, None) or "none"].append(elapsed)
+        return elapsed
+
+
+def instrument(main, commands, recorder):
+
+    run_update = main.run_update
+
+    def traced_run_update(update, *args):
+        recorder.begin_update()
+        try:
+            return run_update(update, *args)
+        finally:
+            recorder.end_update(update.update_id)
+
+    main.run_update = traced_run_update
+
+    names = {cls: name for name, cls in commands.cmd_classes.items()}
+    cmd_run = commands.Command.cmd_run
+    arg_run = commands.Command.arg_run
+
+    def traced_cmd_run(self, *args, **kwargs):
+        recorder.label(names.get(type(self), type(self).__name__))
+        return cmd_run(self, *args, **kwargs)
+
+    def traced_arg_run(self, *args, **kwargs):
+        recorder.label(names.get(type(self), type(self).__name__) + ":arg")
+        return arg_run(self, *args, **kwargs)
+
+    commands.Command.cmd_run = traced_cmd_run
+    commands.Command.arg_run = traced_arg_run
+
+
+class Player(object):
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.username = "player{}".format(user_id)
+
+
+class Script(object):
+
+    update_ids = itertools.count(1)
+    message_ids = itertools.count(1)
+
+    def __init__(self, white, black, moves, rng):
+        self.white = white
+        self.black = black
+        self.moves = moves
+        self.rng = rng
+
+    def _from(self, player):
+        return {"id": player.user_id, "is_bot": False, "first_name": player.username, "username": player.username}
+
+    def message(self, player, text):
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids),
+                "from": self._from(player),
+                "chat": {"id": player.user_id, "type": "private"},
+                "date": int(time.time()),
+                "text": text,
+            },
+        }
+
+    def callback(self, player, data):
+        return {
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": str(next(self.message_ids)),
+                "from": self._from(player),
+                "chat_instance": str(player.user_id),
+                "message": {
+                    "message_id": next(self.message_ids),
+                    "chat": {"id": player.user_id, "type": "private"},
+                    "date": int(time.time()),
+                },
+                "data": data,
+            },
+        }
+
+    def updates(self):
+
+        # Black invites white, so white moves first after accepting
+        yield self.message(self.white, "/start")
+        yield self.message(self.black, "/start")
+        yield self.message(self.black, "/new")
+        yield self.message(self.black, "1 Hour")
+        yield self.message(self.black, self.white.username)
+        yield self.callback(self.white, "/accept")
+
+        players = itertools.cycle([self.white, self.black])
+        for move in self.moves:
+            player = next(players)
+
+            yield self.message(player, move)
+            yield self.callback(player, "/accept")
+
+            roll = self.rng.random()
+            if roll < 0.1:
+                yield self.message(player, "/board")
+            elif roll < 0.2:
+                yield self.message(player, "/info")
+            elif roll < 0.25:
+                yield self.message(player, "/chat")
+                yield self.message(player, "Good move!")
+
+        yield self.message(self.white, "/stop")
+
+
+def random_game(chess, rng, length):
+
+    board = chess.Board()
+    moves = []
+    while len(moves) < length and not board.is_game_over():
+        move = rng.choice(list(board.legal_moves))
+        board.push(move)
+        moves.append(move.uci())
+
+    return moves
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values)*fraction))]
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pairs", type=int, default=20)
+    parser.add_argument("--moves", type=int, default=30)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Simulated Telegram latency in seconds")
+    parser.add_argument("--renderer", default="svg")
+    parser.add_argument("--sync-send", action="store_true", help="Send Telegram calls inline")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fakes.install()
+    fakes.FakeBot.latency = args.api_latency
+
+    with tempfile.NamedTemporaryFile("w", suffix=".cfg", delete=False) as config:
+        config.write(CONFIG.format(hook=HOOK, async_send=not args.sync_send, renderer=args.renderer))
+    os.environ["CHESS_DUEL_SETTINGS"] = config.name
+
+    import chess
+    import main as bot_main
+    import commands
+    from shared import dispatcher
+
+    recorder = Recorder()
+    instrument(bot_main, commands, recorder)
+
+    rng = random.Random(args.seed)
+    scripts = []
+    for i in range(args.pairs):
+        white = Player(1000 + 2*i)
+        black = Player(1001 + 2*i)
+        scripts.append(Script(white, black, random_game(chess, rng, args.moves), random.Random(rng.random())))
+
+    def run(script):
+        client = bot_main.app.test_client()
+        count = 0
+        for update in script.updates():
+            recorder.start()
+            response = client.post(HOOK, data=json.dumps(update), content_type="application/json")
+            recorder.stop(update["update_id"])
+            if response.status_code != 200:
+                print("Update {} failed with {}".format(update["update_id"], response.status_code))
+            count += 1
+        return count
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        total = sum(executor.map(run, scripts))
+    elapsed = time.perf_counter() - start
+
+    dispatcher.join()
+    drained = time.perf_counter() - start
+
+    print("{} updates in {:.2f}s: {:.1f} updates/s ({:.2f}s until all messages were sent)".format(
+        total, elapsed, total/elapsed, drained))
+    print()
+
+    print("{:<16}{:>8}{:>10}{:>10}{:>10}{:>10}".format("command", "count", "mean ms", "p50 ms", "p95 ms", "p99 ms"))
+    for name, values in sorted(recorder.latencies.items()):
+        print("{:<16}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+            name, len(values),
+            statistics.mean(values)*1000,
+            percentile(values, 0.5)*1000,
+            percentile(values, 0.95)*1000,
+            percentile(values, 0.99)*1000))
+    print()
+
+    print("Datastore calls: " + ", ".join("{}={}".format(k, v) for k, v in sorted(fakes.datastore_calls.counts.items())))
+    print("Telegram calls:  " + ", ".join("{}={}".format(k, v) for k, v in sorted(fakes.api_calls.counts.items())))
+
+    os.unlink(config.name)
+
+
+if __name__ == "__main__":
+    main()
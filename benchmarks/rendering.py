@@ -0,0 +1,77 @@
+# Compares the board renderers on positions from random games.
+#
+#   python -m benchmarks.rendering [--positions N] [--rounds N]
+
+import argparse
+import random
+import statistics
+import time
+import chess
+import render
+
+
+def random_positions(count, seed):
+
+    rng = random.Random(seed)
+    positions = []
+
+    board = chess.Board()
+    while len(positions) < count:
+        moves = list(board.legal_moves)
+        if not moves or board.fullmove_number > 80:
+            board = chess.Board()
+            continue
+        move = rng.choice(moves)
+        board.push(move)
+        positions.append((board.copy(stack=False), rng.random() < 0.5, move))
+
+    return positions
+
+
+def bench(name, positions, rounds):
+
+    setup_start = time.perf_counter()
+    renderer = render.get_renderer(name)
+    setup_time = time.perf_counter() - setup_start
+
+    timings = []
+    size = 0
+    for _ in range(rounds):
+        for board, flipped, move in positions:
+            start = time.perf_counter()
+            png = renderer(board, flipped, move)
+            timings.append(time.perf_counter() - start)
+            size += len(png)
+
+    return {
+        "setup": setup_time*1000,
+        "mean": statistics.mean(timings)*1000,
+        "median": statistics.median(timings)*1000,
+        "p95": sorted(timings)[int(len(timings)*0.95)]*1000,
+        "bytes": size // len(timings),
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--positions", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    positions = random_positions(args.positions, args.seed)
+
+    results = {}
+    for name in ("svg", "raster"):
+        results[name] = bench(name, positions, args.rounds)
+
+    print("{:<8}{:>12}{:>12}{:>12}{:>12}{:>12}".format("renderer", "setup ms", "mean ms", "median ms", "p95 ms", "avg bytes"))
+    for name, result in results.items():
+        print("{:<8}{setup:>12.1f}{mean:>12.2f}{median:>12.2f}{p95:>12.2f}{bytes:>12d}".format(name, **result))
+
+    print("Speedup: {:.1f}x".format(results["svg"]["mean"] / results["raster"]["mean"]))
+
+
+if __name__ == "__main__":
+    main()
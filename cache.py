@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    def __init__(self, max_items=None, max_bytes=None, sizeof=len, ttl=None):
+
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size_bytes = 0
+
+        # Values by key, with their size and expiry time
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._lookup(key)
+            if item is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            else:
+                self.misses += 1
+                return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._insert(key, value)
+
+    def put_if_absent(self, key, value):
+        # Atomic check and set, returns False if the key was already there
+        with self._lock:
+            if self._lookup(key) is not None:
+                return False
+            self._insert(key, value)
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                value, size, _ = self._items.pop(key)
+                self.size_bytes -= size
+                return value
+            else:
+                return default
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        return {
+            "items": len(self._items),
+            "bytes": self.size_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _lookup(self, key):
+        item = self._items.get(key)
+        if item is not None and item[2] is not None and item[2] < time.monotonic():
+            # Expired
+            self._items.pop(key)
+            self.size_bytes -= item[1]
+            return None
+        return item
+
+    def _insert(self, key, value):
+
+        size = self.sizeof(value) if self.max_bytes else 0
+
+        # Values that can never fit are not cached at all
+        if self.max_bytes and size > self.max_bytes:
+            return
+
+        if key in self._items:
+            self.size_bytes -= self._items.pop(key)[1]
+
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._items[key] = (value, size, expires)
+        self.size_bytes += size
+
+        while self._items and self._is_full():
+            _, (_, evicted_size, _) = self._items.popitem(last=False)
+            self.size_bytes -= evicted_size
+            self.evictions += 1
+
+    def _is_full(self):
+        if self.max_items is not None and len(self._items) > self.max_items:
+            return True
+        if self.max_bytes is not None and self.size_bytes > self.max_bytes:
+            return True
+        return False
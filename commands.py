@@ -1,12 +1,18 @@
-from shared import app, bot
+from shared import app
 
 import logging
 from datetime import datetime
 import telegram
+import archive
+import chess
 import constants
-from data import UserStatus, User, Match
+from data import UserStatus, User, UsernameIndex, Match, ENGINE_USER_ID, normalize_username, send_boards
 import humanfriendly
 import game
+import metrics
+import pgn
+import session
+from archive import Termination
 from game import GameResult, MoveResult
 
 
@@ -25,8 +31,16 @@ class Command(object):
     def cmd_body(self):
         pass
 
+    def name(self):
+        return cmd_names.get(type(self), type(self).__name__)
+
     def cmd_run(self, force=False):
 
+        with metrics.command_latency.time(command=self.name(), phase="cmd"):
+            self._cmd_run(force)
+
+    def _cmd_run(self, force):
+
         user = self.user
 
         if self.admin_only and not user.admin:
@@ -47,8 +61,10 @@ class Command(object):
         pass
 
     def arg_run(self):
-        self.user.clear_cmd()
-        self.arg_body()
+
+        with metrics.command_latency.time(command=self.name(), phase="arg"):
+            self.user.clear_cmd()
+            self.arg_body()
 
 
 ##################################################
@@ -95,7 +111,7 @@ class New1(Command):
             if timeout:
                 user.send_message("Timeout selected!", reply_markup=telegram.ReplyKeyboardRemove(True))
                 user.pending_arg = str(timeout)
-                user.put()
+                session.save(user)
                 command_handler = New2(user, '/new2', self.message_id)
                 command_handler.cmd_run(True)
             else:
@@ -105,6 +121,47 @@ class New1(Command):
 
 
 
+class Computer(Command):
+
+    def __init__(self, user, text, message_id):
+        super(Computer, self).__init__(user, text, message_id, False, UserStatus.IDLE, True)
+
+    def cmd_body(self):
+
+        custom_keyboard = []
+        for level in constants.COMPUTER_LEVELS:
+            custom_keyboard.append([level])
+        reply_markup = telegram.ReplyKeyboardMarkup(custom_keyboard, resize_keyboard=True)
+
+        self.user.send_message("Please choose the strength of the computer, or /cancel.", reply_markup=reply_markup)
+
+        return True
+
+    def arg_body(self):
+
+        user = self.user
+
+        if self.text == "/cancel":
+            user.send_message("Game cancelled!", reply_markup=telegram.ReplyKeyboardRemove(True))
+        elif self.text in constants.COMPUTER_LEVELS:
+            match = Match(white_id=user.key.id(),
+                          black_id=ENGINE_USER_ID,
+                          timeout=constants.COMPUTER_TIMEOUT,
+                          engine_level=constants.COMPUTER_LEVELS[self.text],
+                          last_move_date=datetime.now())
+            session.save(match)
+
+            user.match_id = match.key.id()
+            user.adversary_id = ENGINE_USER_ID
+            user.start_match()
+
+            user.send_message("Game started!", reply_markup=telegram.ReplyKeyboardRemove(True))
+            user.send_board(match)
+            user.send_message(constants.STRING_GAME_TURN_YOUR)
+        else:
+            user.send_message("Unknown level!", reply_markup=telegram.ReplyKeyboardRemove(True))
+
+
 class New2(Command):
 
     def __init__(self, user, text, message_id):
@@ -136,14 +193,21 @@ class New2(Command):
         if self.text == "/cancel":
             user.send_message("Game cancelled!", reply_markup=telegram.ReplyKeyboardRemove(True))
         else:
-            if adversary_username == user.username and not user.admin:
+            if normalize_username(adversary_username) == normalize_username(user.username) and not user.admin:
                 user.send_message(constants.ERROR_SAME_USER, reply_markup=telegram.ReplyKeyboardRemove(True))
                 return
 
-            query = User.query(User.username == adversary_username)
-            query_list = list(query.fetch())
-
-            if len(query_list) != 1:
+            adversary = UsernameIndex.lookup(adversary_username)
+            if not adversary:
+                # Users who haven't been indexed yet
+                query = User.query(User.username == adversary_username)
+                query_list = list(query.fetch())
+                if len(query_list) == 1:
+                    adversary = query_list[0]
+                    session.add(adversary)
+                    UsernameIndex.register(adversary)
+
+            if not adversary:
                 # Adversary not found
                 invite_button = [[telegram.InlineKeyboardButton("Invite a friend", switch_inline_query=constants.STRING_SHARED)]]
                 reply_markup = telegram.InlineKeyboardMarkup(invite_button)
@@ -151,37 +215,51 @@ class New2(Command):
                 user.send_message(constants.STRING_INVITE, reply_markup=reply_markup)
                 return
 
-            adversary = query_list[0]
-            if adversary.status == UserStatus.IDLE:
-
-                try:
-                    timeout = int(user.pending_arg)
-                except ValueError:
-                    # TODO: Print error
-                    return
-
-                match = Match(white_id=adversary.key.id(),
-                            black_id=user.key.id(),
-                            timeout=timeout)
-                match.put()
-
-                # Adversary found
-                user.setup_match(match, adversary, False)
-                user.send_message(constants.STRING_REQUEST_SENT, reply_markup=telegram.ReplyKeyboardRemove(True))
-
-                adversary.setup_match(match, user, True)
-                accept_button = [[telegram.InlineKeyboardButton("Accept", callback_data='/accept'),
-                                telegram.InlineKeyboardButton("Refuse", callback_data='/refuse')]]
-                reply_markup = telegram.InlineKeyboardMarkup(accept_button)
-                adversary.send_message(
-                    constants.STRING_REQUEST_RECEIVED.format(
-                        user.username,
-                        humanfriendly.format_timespan(match.timeout)),
-                    reply_markup=reply_markup)
-            else:
+            try:
+                timeout = int(user.pending_arg)
+            except ValueError:
+                # TODO: Print error
+                return
+
+            # The adversary is changed from the lane of the user: both are
+            # read again and changed in a transaction
+            game.transaction(invite, user.key.id(), adversary.key.id(), timeout)
+
+
+def invite(user_id, adversary_id, timeout):
+
+    user = session.get(User, user_id)
+    adversary = session.get(User, adversary_id)
+
+    if user.status != UserStatus.IDLE:
+        # Invited in the meantime
+        user.send_message(constants.ERROR_CMD_BAD, reply_markup=telegram.ReplyKeyboardRemove(True))
+        return
+
+    if not adversary or adversary.status != UserStatus.IDLE:
+
+        # Adversary busy
+        user.send_message("Adversary is busy", reply_markup=telegram.ReplyKeyboardRemove(True))
+        return
+
+    match = Match(white_id=adversary.key.id(),
+                black_id=user.key.id(),
+                timeout=timeout)
+    session.save(match)
+
+    # Adversary found
+    user.setup_match(match, adversary, False)
+    user.send_message(constants.STRING_REQUEST_SENT, reply_markup=telegram.ReplyKeyboardRemove(True))
 
-                # Adversary busy
-                user.send_message("Adversary is busy", reply_markup=telegram.ReplyKeyboardRemove(True))
+    adversary.setup_match(match, user, True)
+    accept_button = [[telegram.InlineKeyboardButton("Accept", callback_data='/accept'),
+                    telegram.InlineKeyboardButton("Refuse", callback_data='/refuse')]]
+    reply_markup = telegram.InlineKeyboardMarkup(accept_button)
+    adversary.send_message(
+        constants.STRING_REQUEST_RECEIVED.format(
+            user.username,
+            humanfriendly.format_timespan(match.timeout)),
+        reply_markup=reply_markup)
 
 
 class AcceptRequest(Command):
@@ -196,20 +274,21 @@ class AcceptRequest(Command):
         match = user.get_match()
 
         # Remove inline button
-        bot.deleteMessage(user.chat_id, self.message_id)
+        user.delete_message(self.message_id)
 
         # Update last move
         match.last_move_date = datetime.now()
-        match.put()
+        session.save(match)
 
         user.start_match()
         user.send_message("Request accepted!")
-        user.send_photo(photo=match.get_board_img(user))
-        user.send_message("It's your turn!")
 
         adversary.start_match()
         adversary.send_message(user.username + " has accepted your request.")
-        adversary.send_photo(photo=match.get_board_img(adversary))
+
+        send_boards(match, [(user, {}), (adversary, {})])
+
+        user.send_message("It's your turn!")
         adversary.send_message("It's " + user.username + " turn...")
 
 
@@ -225,10 +304,10 @@ class RefuseRequest(Command):
         match = user.get_match()
 
         # Remove inline button
-        bot.deleteMessage(user.chat_id, self.message_id)
+        user.delete_message(self.message_id)
 
-        # Delete match
-        match.key.delete()
+        # Delete match, nothing was played
+        session.delete(match.key)
 
         # Reset users
         user.reset()
@@ -247,6 +326,11 @@ class CancelRequest(Command):
 
         user = self.user
         adversary = user.get_adversary()
+        match = user.get_match()
+
+        # Delete match, nothing was played
+        if match:
+            session.delete(match.key)
 
         user.reset()
         user.send_message("Request cancelled!")
@@ -277,9 +361,9 @@ class Stop(Command):
         adversary.send_message(user.username + " has cancelled the game.")
         adversary.end_game(GameResult.WIN)
 
-        # Delete match
+        # Archive match
         if match:
-            match.key.delete()
+            archive.archive_match(match, [user, adversary], Termination.RESIGNED, winner=adversary)
 
 
 class Move1(Command):
@@ -314,7 +398,7 @@ class Move1(Command):
         move_result = game.check_move(board, self.text)
         if int(move_result) >= 0:
             user.pending_arg = self.text
-            user.put()
+            session.save(user)
             command_handler = Move2(user, '/move2', self.message_id)
             command_handler.cmd_run(True)
         else:
@@ -348,7 +432,7 @@ class Move2(Command):
             accept_button = [[telegram.InlineKeyboardButton("Accept", callback_data='/accept'),
                               telegram.InlineKeyboardButton("Cancel", callback_data='/cancel')]]
             reply_markup = telegram.InlineKeyboardMarkup(accept_button)
-            user.send_photo(photo=match.get_board_img(user, user.pending_arg), caption="Do you want to confirm this move?", reply_markup=reply_markup)
+            user.send_board(match, user.pending_arg, caption="Do you want to confirm this move?", reply_markup=reply_markup)
 
         return True
 
@@ -358,11 +442,11 @@ class Move2(Command):
         match = user.get_match()
 
         # Remove inline button
-        bot.deleteMessage(user.chat_id, self.message_id)
+        user.delete_message(self.message_id)
 
         if self.text == "/cancel":
             user.send_message("Move cancelled.")
-            user.send_photo(photo=match.get_board_img(user))
+            user.send_board(match)
         elif self.text == "/accept":
             game.move(user, user.pending_arg)
 
@@ -415,7 +499,82 @@ class Board(Command):
         user = self.user
         match = user.get_match()
 
-        user.send_photo(photo=match.get_board_img(user))
+        user.send_board(match)
+
+
+class Pgn(Command):
+
+    def __init__(self, user, text, message_id):
+        super(Pgn, self).__init__(user, text, message_id, False)
+
+    def cmd_body(self):
+
+        user = self.user
+
+        # The game in progress, or else the last finished one
+        match = user.get_match() if user.status == UserStatus.PLAYING else None
+        if match:
+            match_id = match.key.id()
+            adversary = user.get_adversary()
+            adversary_name = adversary.username if adversary else None
+
+            if match.get_color(user) == chess.WHITE:
+                document = pgn.match_pgn(match, user.username, adversary_name)
+            else:
+                document = pgn.match_pgn(match, adversary_name, user.username)
+        else:
+            games = archive.user_games(user.key.id(), limit=1)
+            if not games:
+                user.send_message(constants.ERROR_PGN_NO_GAMES)
+                return
+
+            archived = games[0]
+            match_id = archived.match_id
+            document = pgn.match_pgn(archived, archived.white_name, archived.black_name, archived.result)
+
+        user.send_document(document.encode(), "chess-duel-{}.pgn".format(match_id))
+
+
+class Eval(Command):
+
+    def __init__(self, user, text, message_id):
+        super(Eval, self).__init__(user, text, message_id, False, UserStatus.PLAYING)
+
+    def cmd_body(self):
+
+        match = self.user.get_match()
+        board = match.get_board()
+
+        # Replies when the search is done, right away for known positions
+        evaluation = game.evaluate(board)
+        evaluation.add_done_callback(lambda evaluation: self.reply(board, evaluation))
+
+    def reply(self, board, evaluation):
+
+        user = self.user
+
+        error = evaluation.exception()
+        if error:
+            logging.error("Unable to evaluate %s: %s", board.fen(), error)
+            user.send_message(constants.ERROR_EVAL)
+            return
+
+        score, move, depth = evaluation.result()
+
+        # From white's point of view
+        if board.turn == chess.BLACK:
+            score = -score
+
+        user.send_message(constants.STRING_GAME_EVAL.format(game.format_score(score), depth, move or "-"))
+
+
+class Draw(Command):
+
+    def __init__(self, user, text, message_id):
+        super(Draw, self).__init__(user, text, message_id, False, UserStatus.PLAYING)
+
+    def cmd_body(self):
+        game.claim_draw(self.user)
 
 
 ##################################################
@@ -467,7 +626,7 @@ class Silence(Command):
         else:
             # Enable silent chat
             user.silence = True
-            user.put()
+            session.save(user)
             user.send_message(constants.STRING_SILENCE_SELF_ON)
             if user.status == UserStatus.PLAYING:
                 adversary = user.get_adversary()
@@ -489,7 +648,7 @@ class Unsilence(Command):
         else:
             # Disable silent chat
             user.silence = False
-            user.put()
+            session.save(user)
             user.send_message(constants.STRING_SILENCE_SELF_OFF)
             if user.status == UserStatus.PLAYING:
                 adversary = user.get_adversary()
@@ -542,7 +701,7 @@ class Admin(Command):
                 return
             elif self.text == app.config["ADMIN_PASS"]:
                 user.admin = True
-                user.put()
+                session.save(user)
                 user.send_message("User promoted to admin!")
         else:
             user.send_message(constants.ERROR_BAD_INPUT_GENERAL)
@@ -552,11 +711,15 @@ cmd_classes = {
     'start': Start,
     'new': New1,
     'new2': New2,
+    'computer': Computer,
     'stop': Stop,
     'move': Move1,
     'move2': Move2,
     'chat': Chat,
     'board': Board,
+    'pgn': Pgn,
+    'eval': Eval,
+    'draw': Draw,
     'accept': AcceptRequest,
     'refuse': RefuseRequest,
     'cancel': CancelRequest,
@@ -568,9 +731,17 @@ cmd_classes = {
     'admin': Admin,
 }
 
+cmd_names = {cls: name for name, cls in cmd_classes.items()}
+
 
 def handle_input(user, text, message_id):
 
+    with metrics.input_latency.time():
+        _handle_input(user, text, message_id)
+
+
+def _handle_input(user, text, message_id):
+
     # Text must always exist
     if not text:
         logging.debug("User %s has sent an empty message", user.username)
@@ -0,0 +1,106 @@
+from shared import app, dispatcher, ndb_client, scheduler
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+import data
+import engine
+import game
+import metrics
+import session
+
+
+# Search depth and time budget in seconds, by strength level
+LEVELS = {
+    1: (1, 0.1),
+    2: (2, 0.5),
+    3: (4, 1.0),
+    4: (6, 3.0),
+}
+
+
+class MoveQueue(object):
+
+    # Computer replies waiting for a search, shortest searches first. Only
+    # one search per worker is handed to the engine pool at a time, so that
+    # a backlog of computer moves can't hold up /eval. A position is queued
+    # once until its search is done, however often a late match asks again.
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self._heap = []
+        self._queued = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def put(self, match_id, fen, level):
+        with self._cond:
+            if not self._threads:
+                self._start()
+
+            if self._queued.get(match_id) == fen:
+                return
+            self._queued[match_id] = fen
+
+            depth, budget = LEVELS[level]
+            heapq.heappush(self._heap, (budget, next(self._seq), time.perf_counter(), match_id, fen, depth))
+            self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name="computer-{}".format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                budget, _, queued, match_id, fen, depth = heapq.heappop(self._heap)
+
+            try:
+                score, move, _ = game.engine_pool.get().submit(engine.search, fen, budget, depth).result()
+                if move:
+                    # In the lane of the match, after the updates already there
+                    scheduler.submit(("match", match_id), apply_move, match_id, fen, move).result()
+            except Exception:
+                logging.exception("Unable to play the computer move of match %s", match_id)
+            finally:
+                with self._cond:
+                    if self._queued.get(match_id) == fen:
+                        del self._queued[match_id]
+
+            metrics.computer_latency.observe(time.perf_counter() - queued)
+
+
+queue = MoveQueue(app.config.get('COMPUTER_WORKERS', 1))
+
+
+def schedule(match):
+
+    # Queues the computer reply once the position is stored
+    match_id, fen, level = match.key.id(), match.fen, match.engine_level
+    session.defer(lambda: queue.put(match_id, fen, level))
+
+
+def apply_move(match_id, fen, move_code):
+
+    # Plays the reply like any other move, unless the match went on
+    with ndb_client.context(), session.scope(app.config.get('UOW_TRANSACTIONAL', False)):
+        with dispatcher.hold() as outbox:
+            match = session.get(data.Match, match_id)
+            if not match or match.fen != fen:
+                return
+
+            game.move(data.engine_user(match), move_code)
+            session.flush()
+
+        outbox.release(dispatcher)
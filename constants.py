@@ -24,15 +24,19 @@ move, or by simply typing the coordinates.
 *General*:
 
 /new - Start a new game
+/computer - Play against the computer
 
 *In-Game:*
 /chat - Chat with the adversary
 /move - Move a piece
 /board - Show the board
+/eval - Evaluate the position
+/draw - Claim a draw by repetition or the fifty-move rule
 /stop - Cancel the current game
 
 *General:*
 /info - Show user/game information
+/pgn - Download the current or last game as PGN
 /silence - Silence the chat
 /unsilence - Unsilence the chat
 /about - Show info on this bot
@@ -63,7 +67,14 @@ User since: _{}_
 STRING_GAME_TURN_YOUR = "It's your turn!"
 STRING_GAME_TURN_WAIT = "It's {} turn..."
 STRING_GAME_STALEMATE = "Stalemate!"
+STRING_GAME_REPETITION = "Draw by threefold repetition!"
+STRING_GAME_FIVEFOLD = "Draw by fivefold repetition!"
+STRING_GAME_FIFTY = "Draw by the fifty-move rule!"
+STRING_GAME_SEVENTY_FIVE = "Draw by the seventy-five-move rule!"
+STRING_GAME_DRAW_CLAIMABLE = "You can claim a draw with /draw."
+STRING_GAME_DRAW_CLAIMED = "{} claimed a draw."
 STRING_GAME_CHECK = "Check! :grimacing:"
+STRING_GAME_EVAL = "Evaluation: *{}* (depth {})\nBest move: *{}*"
 STRING_GAME_CHECKMATE_WIN = "Checkmate! You win! :sunglasses:"
 STRING_GAME_CHECKMATE_LOSE = "Checkmate! {} wins the game! :cry:"
 STRING_GAME_END = """\
@@ -96,17 +107,30 @@ More info at this [link](https://telegram.org/faq#q-what-are-usernames-how-do-i-
 ERROR_MOVE_BAD = "You can't do this move!"
 ERROR_MOVE_UNKNOWN = "Sorry, I don't understand this move!"
 ERROR_TURN = "It's not your turn!"
+ERROR_DRAW_CLAIM = "There's no draw to claim in this position."
 ERROR_CHAT_SILENT = "Chat is already silent!"
 ERROR_CHAT_NOT_SILENT = "Chat is already active!"
 ERROR_BAD_INPUT_GENERAL = "Unknown input. Do you need /help?"
 ERROR_SAME_USER = "You can't play a game against yourself!"
 ERROR_TIMEOUT = "Timeout! User {} failed to move in {}."
 ERROR_BAD_TIMEOUT = "Invalid timeout!"
+ERROR_PGN_NO_GAMES = "You have no games to download yet."
+ERROR_EVAL = "Sorry, I can't evaluate the position right now."
 
 # HTTP responses
 RESPONSE_OK = "OK"
 RESPONSE_FAIL = "FAIL"
 
+# Computer
+STRING_COMPUTER = "Computer"
+COMPUTER_LEVELS = {
+        "Easy": 1,
+        "Medium": 2,
+        "Hard": 3,
+        "Expert": 4
+}
+COMPUTER_TIMEOUT = 7*24*3600
+
 # Game
 MATCH_TIMEOUTS = {
         "10 Minutes": 10*60,
@@ -1,20 +1,88 @@
-from shared import bot
+from shared import app, bot, dispatcher, Lazy
 
 import io
 import logging
-from datetime import datetime
+from concurrent.futures import Future
+from datetime import datetime, timedelta
 from enum import IntEnum
 from google.cloud import ndb
 import telegram
-import emoji
 import chess
-import chess.svg
-import cairosvg
+import chess.polyglot
 import constants
+import dispatch
 import game
+import history
+import metrics
+import render
+import session
+from cache import LRUCache
 from game import GameResult
 
 
+renderer = Lazy(lambda: render.get_renderer(app.config.get('RENDERER', 'svg')))
+
+# Rendered PNGs, keyed by position, orientation and highlighted move
+board_cache = LRUCache(
+    max_items=app.config.get('RENDER_CACHE_SIZE', 512),
+    max_bytes=app.config.get('RENDER_CACHE_BYTES', 32*1024*1024))
+
+# Telegram file_id of board images already uploaded, keyed as board_cache
+photo_ids = LRUCache(max_items=app.config.get('PHOTO_ID_CACHE_SIZE', 8192))
+
+STARTING_BOARD = chess.Board()
+
+# The computer adversary plays as the bot itself
+ENGINE_USER_ID = int(app.config.get('BOT_TOKEN', '').partition(':')[0] or 0)
+
+
+def emojize(text):
+    # Imported on first use, emoji builds big tables at import time
+    import emoji
+
+    return emoji.emojize(text, use_aliases=True)
+
+
+def render_board(board, flipped, move):
+
+    key = render.board_key(board, flipped, move)
+    png = board_cache.get(key)
+    if png is None:
+        with metrics.render_latency.time():
+            png = renderer.get()(board, flipped, move)
+        metrics.render_size.observe(len(png))
+        board_cache.put(key, png)
+        logging.debug("Board cache miss, %s", board_cache.stats())
+
+    return io.BytesIO(png)
+
+
+def send_boards(match, deliveries):
+
+    # Boards for different users are rendered and sent in parallel by the
+    # dispatcher, each after the messages queued before it. A board that
+    # can't be sent goes as text, so that the user still sees the position.
+    def fallback(user, kwargs, sent):
+        error = sent.exception()
+        if not error:
+            return
+
+        logging.error("Unable to send board to user %s: %s", user.username, error)
+
+        kwargs = dict(kwargs)
+        caption = kwargs.pop("caption", None)
+        board, flipped, move = match.get_board_position(user, kwargs.pop("preview_move", None))
+        rows = str(board).splitlines()
+        if flipped:
+            rows = [row[::-1] for row in reversed(rows)]
+        text = "```\n{}\n```".format("\n".join(rows))
+        user.send_message(caption + "\n" + text if caption else text, **kwargs)
+
+    for user, kwargs in deliveries:
+        sent = user.send_board(match, **kwargs)
+        sent.add_done_callback(lambda sent, user=user, kwargs=kwargs: fallback(user, kwargs, sent))
+
+
 class UserStatus(IntEnum):
     ANY = -1
     IDLE = 0
@@ -52,19 +120,22 @@ class User(ndb.Model):
         self.match_id = None
         self.adversary = None
         self.status = UserStatus.IDLE
-        self.put()
+        session.save(self)
 
     def set_cmd(self, cmd):
         self.pending_cmd = cmd
-        self.put()
+        session.save(self)
 
     def clear_cmd(self):
         self.pending_cmd = None
-        self.put()
+        session.save(self)
 
     def get_adversary(self):
-        if self.adversary_id:
-            adversary = User.get_by_id(self.adversary_id)
+        if self.adversary_id == ENGINE_USER_ID:
+            match = self.get_match()
+            return engine_user(match) if match else None
+        elif self.adversary_id:
+            adversary = session.get(User, self.adversary_id)
             if not adversary:
                 logging.error("Unable to find adversary with id %d", self.adversary_id)
                 self.reset()
@@ -95,15 +166,15 @@ class User(ndb.Model):
         else:
             self.recent_adversaries = [adversary.username]
 
-        self.put()
+        session.save(self)
 
     def start_match(self):
         self.status = UserStatus.PLAYING
-        self.put()
+        session.save(self)
 
     def get_match(self):
         if self.match_id:
-            match = Match.get_by_id(self.match_id)
+            match = session.get(Match, self.match_id)
             if not match:
                 logging.error("Unable to find match with id %d", self.match_id)
                 # TODO: Reset user and adversary
@@ -133,34 +204,184 @@ class User(ndb.Model):
 
     def send_message(self, text, parse_mode=None, disable_web_page_preview=True, disable_notification=False, reply_to_message_id=None, reply_markup=None, timeout=None, **kwargs):
 
-        emoji_text = emoji.emojize(text, use_aliases=True)
+        emoji_text = emojize(text)
+
+        job = dispatch.Job(bot.send_message,
+                           (self.chat_id, emoji_text),
+                           dict(parse_mode=telegram.ParseMode.MARKDOWN,
+                                disable_web_page_preview=disable_web_page_preview,
+                                disable_notification=disable_notification,
+                                reply_to_message_id=reply_to_message_id,
+                                reply_markup=reply_markup,
+                                timeout=timeout,
+                                **kwargs))
+
+        # Plain messages can also go in the webhook reply
+        if app.config.get('WEBHOOK_REPLY', True) and not kwargs:
+            job.webhook = {
+                "method": "sendMessage",
+                "chat_id": self.chat_id,
+                "text": emoji_text,
+                "parse_mode": telegram.ParseMode.MARKDOWN,
+                "disable_web_page_preview": disable_web_page_preview,
+                "disable_notification": disable_notification,
+            }
+            if reply_to_message_id:
+                job.webhook["reply_to_message_id"] = reply_to_message_id
+            if reply_markup:
+                job.webhook["reply_markup"] = reply_markup.to_dict()
+
+        return dispatcher.submit_job(self.chat_id, job)
+
+    def send_photo(self, photo, caption=None, **kwargs):
+
+        return dispatcher.submit(self.chat_id, self._send_photo, photo, caption=caption, **kwargs)
+
+    def send_board(self, match, preview_move=None, caption=None, **kwargs):
 
-        bot.send_message(self.chat_id,
-                         emoji_text,
-                         parse_mode=telegram.ParseMode.MARKDOWN,
-                         disable_web_page_preview=disable_web_page_preview,
-                         disable_notification=disable_notification,
-                         reply_to_message_id=reply_to_message_id,
-                         reply_markup=reply_markup,
-                         timeout=timeout,
-                         **kwargs)
+        board, flipped, move = match.get_board_position(self, preview_move)
 
-    def send_photo(self, photo, caption=None, disable_notification=False, reply_to_message_id=None, reply_markup=None, timeout=20, **kwargs):
+        return dispatcher.submit(self.chat_id, self._send_board, board, flipped, move, caption=caption, **kwargs)
+
+    def send_document(self, document, filename, caption=None, **kwargs):
+
+        return dispatcher.submit(self.chat_id, self._send_document, document, filename, caption=caption, **kwargs)
+
+    def delete_message(self, message_id):
+
+        return dispatcher.submit(self.chat_id, bot.delete_message, self.chat_id, message_id)
+
+    def _send_photo(self, photo, caption=None, disable_notification=False, reply_to_message_id=None, reply_markup=None, timeout=20, **kwargs):
 
         if caption:
-            emoji_text = emoji.emojize(caption, use_aliases=True)
+            emoji_text = emojize(caption)
         else:
             emoji_text = None
 
-        bot.send_photo(self.chat_id,
-                       photo,
-                       caption=emoji_text,
-                       disable_notification=disable_notification,
-                       reply_to_message_id=reply_to_message_id,
-                       reply_markup=reply_markup,
-                       timeout=timeout,
-                       parse_mode=telegram.ParseMode.MARKDOWN,
-                       **kwargs)
+        # Uploads can be retried
+        if hasattr(photo, "seek"):
+            photo.seek(0)
+
+        return bot.send_photo(self.chat_id,
+                              photo,
+                              caption=emoji_text,
+                              disable_notification=disable_notification,
+                              reply_to_message_id=reply_to_message_id,
+                              reply_markup=reply_markup,
+                              timeout=timeout,
+                              parse_mode=telegram.ParseMode.MARKDOWN,
+                              **kwargs)
+
+    def _send_document(self, document, filename, caption=None, timeout=20, **kwargs):
+
+        if caption:
+            emoji_text = emojize(caption)
+        else:
+            emoji_text = None
+
+        # A new file object for each attempt
+        return bot.send_document(self.chat_id,
+                                 io.BytesIO(document),
+                                 filename=filename,
+                                 caption=emoji_text,
+                                 timeout=timeout,
+                                 parse_mode=telegram.ParseMode.MARKDOWN,
+                                 **kwargs)
+
+    def _send_board(self, board, flipped, move, caption=None, **kwargs):
+
+        key = render.board_key(board, flipped, move)
+
+        # Send the image by reference if it was already uploaded
+        file_id = photo_ids.get(key)
+        if file_id:
+            try:
+                return self._send_photo(file_id, caption=caption, **kwargs)
+            except telegram.error.BadRequest as e:
+                logging.warning("File %s rejected (%s), uploading board again", file_id, e)
+                photo_ids.pop(key)
+
+        message = self._send_photo(render_board(board, flipped, move), caption=caption, **kwargs)
+
+        if message and message.photo:
+            # Biggest size is the original upload
+            photo_ids.put(key, message.photo[-1].file_id)
+
+        return message
+
+
+class EngineUser(User):
+
+    # Computer adversary of a match, built on demand and never stored
+    transient = True
+
+    def send_message(self, *args, **kwargs):
+        sent = Future()
+        sent.set_result(None)
+        return sent
+
+    send_photo = send_message
+    send_board = send_message
+    send_document = send_message
+    delete_message = send_message
+
+
+def engine_user(match):
+
+    if match.black_id == ENGINE_USER_ID:
+        user_id = match.white_id
+    else:
+        user_id = match.black_id
+
+    return EngineUser(id=ENGINE_USER_ID,
+                      username=constants.STRING_COMPUTER,
+                      adversary_id=user_id,
+                      match_id=match.key.id(),
+                      status=UserStatus.PLAYING)
+
+
+def get_player(match, user_id):
+    if match.engine_level and user_id == ENGINE_USER_ID:
+        return engine_user(match)
+    else:
+        return session.get(User, user_id)
+
+
+def normalize_username(username):
+    return username.strip().lstrip("@").lower()
+
+
+class UsernameIndex(ndb.Model):
+
+    # Keyed by normalized username
+    user_id = ndb.IntegerProperty(indexed=False)
+
+    @classmethod
+    def lookup(cls, username):
+
+        index = session.get(cls, normalize_username(username))
+        if not index:
+            return None
+
+        user = session.get(User, index.user_id)
+        if user and normalize_username(user.username) == index.key.id():
+            return user
+        else:
+            # User deleted or renamed
+            session.delete(index.key)
+            return None
+
+    @classmethod
+    def register(cls, user, old_username=None):
+
+        name = normalize_username(user.username)
+
+        if old_username and normalize_username(old_username) != name:
+            old_index = session.get(cls, normalize_username(old_username))
+            if old_index and old_index.user_id == user.key.id():
+                session.delete(old_index.key)
+
+        session.save(cls(id=name, user_id=user.key.id()))
 
 
 class Match(ndb.Model):
@@ -172,13 +393,34 @@ class Match(ndb.Model):
     white_id = ndb.IntegerProperty()
     black_id = ndb.IntegerProperty()
 
+    # Moves played, see history.py. start_fen is set for the matches that
+    # were already in progress when the history was introduced
+    start_fen = ndb.StringProperty(indexed=False)
+    moves = ndb.BlobProperty(default=b"")
+    checkpoints = ndb.StringProperty(repeated=True, indexed=False)
+
+    # Repetition counts of the positions since the last irreversible move
+    positions = ndb.BlobProperty(default=b"")
+
     last_move_code = ndb.StringProperty()
     last_move_date = ndb.DateTimeProperty(default=None)
     timeout = ndb.IntegerProperty(default=3600)
 
+    # Strength of the computer adversary, None against a human
+    engine_level = ndb.IntegerProperty(indexed=False)
+
+    # When the player to move runs out of time, indexed for maintainance
+    deadline = ndb.ComputedProperty(
+        lambda self: self.last_move_date + timedelta(seconds=self.timeout) if self.last_move_date else None)
+
     def get_board(self):
 
-        return chess.Board(self.fen)
+        # Parse the FEN once per position
+        if getattr(self, "_board_fen", None) != self.fen:
+            self._board = chess.Board(self.fen)
+            self._board_fen = self.fen
+
+        return self._board.copy()
 
     def move(self, move_code):
 
@@ -188,14 +430,57 @@ class Match(ndb.Model):
         chess_move = game.parse_move(move_code)
         if int(result) >= 0:
 
+            if not self.moves and self.fen != chess.STARTING_FEN:
+                self.start_fen = self.fen
+
+            # Earlier positions can't occur again after an irreversible move
+            counts = history.unpack_counts(self.positions)
+            if board.is_irreversible(chess_move):
+                counts = {}
+            elif not counts:
+                counts[chess.polyglot.zobrist_hash(board)] = 1
+
             board.push(chess_move)
             self.fen = board.fen()
+
+            self.moves = history.append(self.moves, chess_move)
+            if history.is_checkpoint(self.get_ply_count()):
+                self.checkpoints.append(self.fen)
+
+            key = chess.polyglot.zobrist_hash(board)
+            counts[key] = counts.get(key, 0) + 1
+            self.positions = history.pack_counts(counts)
+
+            if result in (game.MoveResult.GOOD, game.MoveResult.CHECK):
+                result = game.check_draw(counts[key], board.halfmove_clock) or result
+
             self.last_move_code = move_code
             self.last_move_date = datetime.now()
-            self.put()
+            session.save(self)
+
+            # Legal moves of the adversary, ready for their reply
+            game.position_moves(board)
 
         return result
 
+    def get_repetitions(self):
+        # Times the current position occurred since the last irreversible move
+        counts = history.unpack_counts(self.positions)
+        return counts.get(chess.polyglot.zobrist_hash(self.get_board()), 1)
+
+    def get_ply_count(self):
+        return history.length(self.moves)
+
+    def get_moves(self):
+        return history.unpack(self.moves)
+
+    def get_board_at(self, ply):
+        # Position after the given number of plies of the recorded history
+        if not 0 <= ply <= self.get_ply_count():
+            raise IndexError("ply out of range")
+
+        return history.board_at(self.start_fen or chess.STARTING_FEN, self.moves, self.checkpoints, ply)
+
     def get_color(self, user):
         if user.key.id() == self.white_id:
             return chess.WHITE
@@ -214,7 +499,7 @@ class Match(ndb.Model):
         else:
             return (board.turn == self.get_color(user))
 
-    def get_board_img(self, user, preview_move=None):
+    def get_board_position(self, user, preview_move=None):
 
         board = self.get_board()
 
@@ -224,38 +509,53 @@ class Match(ndb.Model):
             move = game.parse_move(preview_move)
             board.push(move)
 
-        # Generate SVG
-        if user.key.id() == self.black_id:
-            svg_string = chess.svg.board(
-                board=board,
-                flipped=True,
-                lastmove=move)
-        else:
-            svg_string = chess.svg.board(
-                board=board,
-                flipped=False,
-                lastmove=move)
+        flipped = (user.key.id() == self.black_id)
 
-        # Convert SVG to PNG
-        mem_file = io.BytesIO()
-        cairosvg.svg2png(svg_string, write_to=mem_file)
-        mem_file.seek(0)
+        return board, flipped, move
 
-        return mem_file
+    def get_board_img(self, user, preview_move=None):
+
+        return render_board(*self.get_board_position(user, preview_move))
 
     def get_captured(self, user):
 
         color = not(self.get_color(user))
 
-        dummy = chess.Board()
         board = self.get_board()
 
         output = ""
 
         for piece_type in range(1, 7):
-            dummy_count = len(dummy.pieces(piece_type, color))
+            dummy_count = len(STARTING_BOARD.pieces(piece_type, color))
             board_count = len(board.pieces(piece_type, color))
             delta = dummy_count - board_count
             output += delta*chess.Piece(piece_type, color).unicode_symbol()
 
         return output
+
+
+class TaskCheckpoint(ndb.Model):
+
+    # Where an interrupted maintainance task resumes, keyed by task name
+    cursor = ndb.StringProperty(indexed=False)
+    cutoff = ndb.DateTimeProperty(indexed=False)
+    update_date = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class ProcessedUpdate(ndb.Model):
+
+    # Telegram updates already handled, keyed by update_id
+    expire_date = ndb.DateTimeProperty()
+
+    @classmethod
+    def claim(cls, update_id, ttl):
+
+        def txn():
+            # Not through the context cache, a retry would find the entity
+            # the failed attempt put there
+            if cls.get_by_id(update_id, use_cache=False):
+                return False
+            cls(id=update_id, expire_date=datetime.now() + timedelta(seconds=ttl)).put(use_cache=False)
+            return True
+
+        return ndb.transaction(txn)
@@ -0,0 +1,45 @@
+from shared import app
+
+import logging
+from google.cloud import ndb
+from cache import LRUCache
+from data import ProcessedUpdate
+
+
+# Telegram redelivers updates the webhook is slow to acknowledge, each
+# update_id is processed once
+TTL = app.config.get('DEDUP_TTL', 3600)
+
+seen = LRUCache(max_items=app.config.get('DEDUP_CACHE_SIZE', 100000), ttl=TTL)
+
+
+def claim(update_id):
+    # Returns False if the update was already processed
+
+    if update_id is None:
+        return True
+
+    if not seen.put_if_absent(update_id, True):
+        return False
+
+    # Shared between instances
+    if app.config.get('DEDUP_DATASTORE', False):
+        try:
+            if not ProcessedUpdate.claim(update_id, TTL):
+                return False
+        except Exception:
+            logging.exception("Unable to check update %s in datastore", update_id)
+
+    return True
+
+
+def release(update_id):
+    # Lets a failed update be processed again when redelivered
+
+    seen.pop(update_id)
+
+    if app.config.get('DEDUP_DATASTORE', False):
+        try:
+            ndb.Key(ProcessedUpdate, update_id).delete()
+        except Exception:
+            logging.exception("Unable to release update %s", update_id)
@@ -0,0 +1,361 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import telegram
+import metrics
+from cache import LRUCache
+
+
+_local = threading.local()
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.timestamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp)*self.rate)
+        self.timestamp = now
+
+    def delay(self, now):
+        # Seconds to wait before a token is available
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        else:
+            return (1 - self.tokens)/self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        # Empty the bucket so that the next token comes in the given time
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds*self.rate)
+
+
+class Job(object):
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+
+        # Method call for a webhook reply, for the calls that can be one
+        self.webhook = None
+
+
+def is_idempotent(job):
+    # A send that timed out may have been delivered, deletes and edits can
+    # safely run twice
+    return not job.fn.__name__.strip("_").startswith("send")
+
+
+def call(job):
+
+    method = job.fn.__name__.strip("_")
+    start = time.perf_counter()
+
+    try:
+        result = job.fn(*job.args, **job.kwargs)
+    except Exception as e:
+        metrics.telegram_calls.inc(method=method, result=type(e).__name__)
+        raise
+    finally:
+        metrics.telegram_latency.observe(time.perf_counter() - start, method=method)
+
+    metrics.telegram_calls.inc(method=method, result="ok")
+    return result
+
+
+def run_job(job, max_retries):
+    # Runs a job once, returns the seconds to wait before retrying it or None
+    # when the job is done
+
+    job.attempts += 1
+
+    try:
+        result = call(job)
+    except telegram.error.RetryAfter as e:
+        # Flood control (HTTP 429)
+        logging.warning("Flood control exceeded, retrying in %d seconds", e.retry_after)
+        if job.attempts <= max_retries:
+            return e.retry_after
+        job.future.set_exception(e)
+    except telegram.error.BadRequest as e:
+        logging.error("Telegram rejected the request: %s", e)
+        job.future.set_exception(e)
+    except telegram.error.TimedOut as e:
+        if is_idempotent(job) and job.attempts <= max_retries:
+            logging.warning("Telegram timed out, retrying")
+            return 2**(job.attempts - 1)
+        logging.error("Telegram timed out, the call may have gone through: %s", e)
+        job.future.set_exception(e)
+    except telegram.error.NetworkError as e:
+        if job.attempts <= max_retries:
+            logging.warning("Network error (%s), retrying", e)
+            return 2**(job.attempts - 1)
+        logging.error("Unable to send to Telegram: %s", e)
+        job.future.set_exception(e)
+    except Exception as e:
+        logging.exception("Unable to send to Telegram")
+        job.future.set_exception(e)
+    else:
+        job.future.set_result(result)
+
+    return None
+
+
+class Outbox(object):
+
+    # Calls held while an update is handled, sent once it's done
+
+    def __init__(self):
+        self.jobs = []
+
+    def release(self, dispatcher, reply_chat_id=None):
+        # Sends the held calls. The last one to reply_chat_id is returned as
+        # the webhook reply instead, if it can be one and nothing else is
+        # still queued for that chat (it would arrive first)
+
+        reply = None
+        if reply_chat_id is not None:
+            chat_jobs = [job for chat_id, job in self.jobs if chat_id == reply_chat_id]
+            if chat_jobs and chat_jobs[-1].webhook:
+                reply = chat_jobs[-1]
+
+        dispatcher.submit_all([(chat_id, job) for chat_id, job in self.jobs if job is not reply])
+        self.jobs = []
+
+        if reply:
+            if dispatcher.pending(reply_chat_id) == 0:
+                reply.future.set_result(None)
+                metrics.telegram_calls.inc(method=reply.webhook["method"], result="webhook")
+                return reply.webhook
+            dispatcher.submit_all([(reply_chat_id, reply)])
+
+        return None
+
+
+class BaseDispatcher(object):
+
+    def submit(self, chat_id, fn, *args, **kwargs):
+        return self.submit_job(chat_id, Job(fn, args, kwargs))
+
+    def submit_job(self, chat_id, job):
+
+        outbox = getattr(_local, "outbox", None)
+        if outbox is not None:
+            outbox.jobs.append((chat_id, job))
+        else:
+            self.submit_all([(chat_id, job)])
+
+        return job.future
+
+    @contextmanager
+    def hold(self):
+        # Calls made in this thread are kept in the outbox until released,
+        # they are dropped if the block raises
+
+        previous = getattr(_local, "outbox", None)
+        _local.outbox = Outbox()
+
+        try:
+            yield _local.outbox
+        finally:
+            _local.outbox = previous
+
+
+class SyncDispatcher(BaseDispatcher):
+
+    def __init__(self, workers=8, max_retries=3):
+        self.max_retries = max_retries
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def submit_all(self, jobs):
+
+        # Chats are served in parallel, the jobs of a chat in order
+        chats = OrderedDict()
+        for chat_id, job in jobs:
+            chats.setdefault(chat_id, []).append(job)
+
+        if len(chats) > 1:
+            for future in [self.pool.submit(self._run, chat_jobs) for chat_jobs in chats.values()]:
+                future.result()
+        elif chats:
+            self._run(*chats.values())
+
+    def _run(self, jobs):
+        for job in jobs:
+            delay = run_job(job, self.max_retries)
+            while delay is not None:
+                time.sleep(delay)
+                delay = run_job(job, self.max_retries)
+
+    def pending(self, chat_id):
+        return 0
+
+    def join(self, timeout=None):
+        return True
+
+
+class Dispatcher(BaseDispatcher):
+
+    def __init__(self, workers=8, global_rate=30, chat_rate=1, chat_burst=3, max_retries=3):
+
+        self.workers = workers
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = LRUCache(max_items=10000)
+
+        # Jobs per chat, a chat is either waiting in the heap or owned by a
+        # worker so that its jobs are sent in order
+        self._jobs = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit_all(self, jobs):
+
+        with self._cond:
+            if not self._threads:
+                self._start()
+
+            for chat_id, job in jobs:
+                if chat_id in self._jobs:
+                    self._jobs[chat_id].append(job)
+                else:
+                    self._jobs[chat_id] = deque([job])
+                    self._schedule(chat_id, 0)
+
+    def pending(self, chat_id):
+        with self._cond:
+            return len(self._jobs.get(chat_id, ()))
+
+    def join(self, timeout=None):
+        # Waits until all queued jobs are sent
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._jobs:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name="dispatcher-{}".format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _schedule(self, chat_id, delay):
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), chat_id))
+        self._cond.notify_all()
+
+    def _next_chat(self):
+        # Pops the first chat that can be served, waiting for rate limits
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                ready_at, _, chat_id = self._heap[0]
+                if ready_at > now:
+                    self._cond.wait(ready_at - now)
+                    continue
+
+                bucket = self.chat_buckets.get(chat_id)
+                if bucket is None:
+                    bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                    self.chat_buckets.put(chat_id, bucket)
+
+                delay = max(bucket.delay(now), self.global_bucket.delay(now))
+                heapq.heappop(self._heap)
+                if delay > 0:
+                    self._schedule(chat_id, delay)
+                    continue
+
+                bucket.take()
+                self.global_bucket.take()
+                return chat_id, bucket
+
+    def _work(self):
+        while True:
+            chat_id, bucket = self._next_chat()
+
+            with self._cond:
+                job = self._jobs[chat_id][0]
+
+            delay = run_job(job, self.max_retries)
+
+            with self._cond:
+                if delay is not None:
+                    # Keep the job at the head of the chat queue
+                    bucket.pause(time.monotonic(), delay)
+                    self._schedule(chat_id, delay)
+                    continue
+
+                jobs = self._jobs[chat_id]
+                jobs.popleft()
+                if jobs:
+                    self._schedule(chat_id, 0)
+                else:
+                    del self._jobs[chat_id]
+                    self._cond.notify_all()
+
+
+class Proxy(BaseDispatcher):
+
+    # The dispatcher everyone imports, forwarding to the one in use. An
+    # entry point with a sender of its own (aioserver.py) installs it here,
+    # so that all calls share its rate limits and per-chat order.
+
+    def __init__(self, target):
+        self.target = target
+
+    def install(self, target):
+        self.target = target
+
+    def submit_all(self, jobs):
+        self.target.submit_all(jobs)
+
+    def pending(self, chat_id):
+        return self.target.pending(chat_id)
+
+    def join(self, timeout=None):
+        return self.target.join(timeout)
+
+
+def create(config):
+
+    if config.get('ASYNC_SEND', True):
+        target = Dispatcher(
+            workers=config.get('SEND_WORKERS', 8),
+            global_rate=config.get('SEND_GLOBAL_RATE', 30),
+            chat_rate=config.get('SEND_CHAT_RATE', 1),
+            chat_burst=config.get('SEND_CHAT_BURST', 3),
+            max_retries=config.get('SEND_MAX_RETRIES', 3))
+    else:
+        target = SyncDispatcher(
+            workers=config.get('SEND_WORKERS', 8),
+            max_retries=config.get('SEND_MAX_RETRIES', 3))
+
+    return Proxy(target)
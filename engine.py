@@ -0,0 +1,273 @@
+# Alpha-beta search used by /eval. Runs in the worker processes of the engine
+# pool, so it only depends on python-chess.
+
+import time
+import chess
+import chess.polyglot
+
+
+MATE = 100000
+INFINITY = MATE + 1
+
+PIECE_VALUES = {
+    chess.PAWN: 100,
+    chess.KNIGHT: 320,
+    chess.BISHOP: 330,
+    chess.ROOK: 500,
+    chess.QUEEN: 900,
+    chess.KING: 0,
+}
+
+# Piece-square tables from white's point of view, a8 first
+PIECE_SQUARES = {
+    chess.PAWN: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0),
+    chess.KNIGHT: (
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50),
+    chess.BISHOP: (
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20),
+    chess.ROOK: (
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0),
+    chess.QUEEN: (
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20),
+    chess.KING: (
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20),
+}
+
+# Transposition table entry bounds
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+# Transposition table by position hash, kept by each worker process across
+# searches and cleared when it grows past TABLE_SIZE entries
+table = {}
+TABLE_SIZE = 1 << 20
+
+# Nodes searched between two checks of the time budget
+CHECK_NODES = 1024
+
+
+class Timeout(Exception):
+    pass
+
+
+def evaluate(board):
+
+    # Material and piece placement, from the point of view of the side to move
+    score = 0
+    for square, piece in board.piece_map().items():
+        if piece.color == chess.WHITE:
+            score += PIECE_VALUES[piece.piece_type] + PIECE_SQUARES[piece.piece_type][chess.square_mirror(square)]
+        else:
+            score -= PIECE_VALUES[piece.piece_type] + PIECE_SQUARES[piece.piece_type][square]
+
+    return score if board.turn == chess.WHITE else -score
+
+
+def _to_table(score, ply):
+    # Mate scores are stored relative to the node, not to the root
+    if score > MATE - 1000:
+        return score + ply
+    elif score < -MATE + 1000:
+        return score - ply
+    return score
+
+
+def _from_table(score, ply):
+    if score > MATE - 1000:
+        return score - ply
+    elif score < -MATE + 1000:
+        return score + ply
+    return score
+
+
+class Search(object):
+
+    def __init__(self, board, deadline):
+        self.board = board
+        self.deadline = deadline
+        self.nodes = 0
+        self.best_move = None
+
+    def tick(self):
+        self.nodes += 1
+        if self.nodes % CHECK_NODES == 0 and time.monotonic() > self.deadline:
+            raise Timeout()
+
+    def order(self, moves, first=None):
+
+        board = self.board
+
+        # Best move from the table, then captures by victim and attacker
+        # value, then promotions
+        def key(move):
+            if move == first:
+                return -INFINITY
+            score = 0
+            if board.is_capture(move):
+                victim = board.piece_type_at(move.to_square) or chess.PAWN
+                score -= 10*PIECE_VALUES[victim] - PIECE_VALUES[board.piece_type_at(move.from_square)]
+            if move.promotion:
+                score -= PIECE_VALUES[move.promotion]
+            return score
+
+        return sorted(moves, key=key)
+
+    def quiesce(self, alpha, beta):
+
+        # Searches captures only, so that the evaluation is not taken in
+        # the middle of an exchange
+        self.tick()
+
+        stand_pat = evaluate(self.board)
+        if stand_pat >= beta:
+            return beta
+        alpha = max(alpha, stand_pat)
+
+        for move in self.order(self.board.generate_legal_captures()):
+            self.board.push(move)
+            score = -self.quiesce(-beta, -alpha)
+            self.board.pop()
+
+            if score >= beta:
+                return beta
+            alpha = max(alpha, score)
+
+        return alpha
+
+    def negamax(self, depth, alpha, beta, ply=0):
+
+        self.tick()
+        board = self.board
+
+        if ply and (board.halfmove_clock >= 100 or board.is_insufficient_material()):
+            return 0
+
+        key = chess.polyglot.zobrist_hash(board)
+        entry = table.get(key)
+        first = None
+        if entry:
+            entry_depth, entry_score, entry_bound, first = entry
+            entry_score = _from_table(entry_score, ply)
+            if ply and entry_depth >= depth:
+                if entry_bound == EXACT:
+                    return entry_score
+                elif entry_bound == LOWER and entry_score >= beta:
+                    return entry_score
+                elif entry_bound == UPPER and entry_score <= alpha:
+                    return entry_score
+
+        if depth <= 0:
+            return self.quiesce(alpha, beta)
+
+        original_alpha = alpha
+        best_score = -INFINITY
+        best_move = None
+
+        for move in self.order(board.legal_moves, first):
+            board.push(move)
+            score = -self.negamax(depth - 1, -beta, -alpha, ply + 1)
+            board.pop()
+
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if ply == 0:
+                    # Kept if the iteration runs out of time
+                    self.best_move = move
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+
+        if best_move is None:
+            # Checkmate or stalemate
+            return -MATE + ply if board.is_check() else 0
+
+        if best_score <= original_alpha:
+            bound = UPPER
+        elif best_score >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+
+        if len(table) >= TABLE_SIZE:
+            table.clear()
+        table[key] = (depth, _to_table(best_score, ply), bound, best_move)
+
+        return best_score
+
+
+def search(fen, time_budget, max_depth):
+
+    # Iterative deepening until the time budget runs out. Returns the score
+    # in centipawns for the side to move, the best move in UCI notation and
+    # the depth of the last complete iteration. The move is None only when
+    # there's no legal move.
+    board = chess.Board(fen)
+    searcher = Search(board, time.monotonic() + time_budget)
+
+    score, depth = evaluate(board), 0
+    for current in range(1, max_depth + 1):
+        try:
+            score = searcher.negamax(current, -INFINITY, INFINITY)
+        except Timeout:
+            break
+
+        depth = current
+
+        # A forced mate won't get any better
+        if abs(score) > MATE - 1000:
+            break
+
+    if searcher.best_move:
+        # The previous best move is searched first, the best one so far is
+        # at least as good
+        return score, searcher.best_move.uci(), depth
+
+    # Out of time before the first root move was searched
+    board = chess.Board(fen)
+    moves = Search(board, None).order(board.legal_moves)
+    return score, moves[0].uci() if moves else None, depth
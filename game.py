@@ -1,7 +1,21 @@
+from shared import app, dispatcher, Lazy
+
+import logging
+import multiprocessing
+import os
+import archive
 import constants
 import chess
+import chess.polyglot
+import computer
+import data
+import engine
+import session
 
+from concurrent.futures import Future, ProcessPoolExecutor
 from enum import IntEnum
+from archive import Termination
+from cache import LRUCache
 
 
 class GameResult(IntEnum):
@@ -17,6 +31,39 @@ class MoveResult(IntEnum):
     CHECK = 1
     CHECKMATE = 2
     STALEMATE = 3
+    REPETITION = 4
+    FIVEFOLD = 5
+    FIFTY = 6
+    SEVENTY_FIVE = 7
+
+
+# Moves that end the game in a draw
+DRAW_STRINGS = {
+    MoveResult.STALEMATE: constants.STRING_GAME_STALEMATE,
+    MoveResult.REPETITION: constants.STRING_GAME_REPETITION,
+    MoveResult.FIVEFOLD: constants.STRING_GAME_FIVEFOLD,
+    MoveResult.FIFTY: constants.STRING_GAME_FIFTY,
+    MoveResult.SEVENTY_FIVE: constants.STRING_GAME_SEVENTY_FIVE,
+}
+
+
+# Legal moves by position hash
+legal_moves = LRUCache(max_items=4096)
+
+# Engine evaluations by position hash
+evaluations = LRUCache(max_items=app.config.get('EVAL_CACHE_SIZE', 4096))
+
+
+def create_engine_pool():
+    # Spawned rather than forked, this process runs the sender threads. The
+    # workers run at a lower priority than the request threads.
+    return ProcessPoolExecutor(max_workers=app.config.get('EVAL_WORKERS', 1),
+                               mp_context=multiprocessing.get_context("spawn"),
+                               initializer=os.nice,
+                               initargs=(app.config.get('ENGINE_NICE', 10),))
+
+
+engine_pool = Lazy(create_engine_pool)
 
 
 def parse_move(move_code):
@@ -27,36 +74,156 @@ def parse_move(move_code):
         return None
 
 
+def classify(board):
+
+    if board.is_checkmate():
+        return MoveResult.CHECKMATE
+    elif board.is_check():
+        return MoveResult.CHECK
+    elif board.is_stalemate():
+        return MoveResult.STALEMATE
+    else:
+        return MoveResult.GOOD
+
+
+def position_moves(board):
+
+    # Legal moves of the position with their result, computed once
+    key = chess.polyglot.zobrist_hash(board)
+
+    moves = legal_moves.get(key)
+    if moves is None:
+        moves = {}
+        for chess_move in board.legal_moves:
+            board.push(chess_move)
+            moves[chess_move] = classify(board)
+            board.pop()
+        legal_moves.put(key, moves)
+
+    return moves
+
+
+def check_draw(repetitions, halfmove_clock):
+
+    # Draws that end the game on their own
+    if repetitions >= 5:
+        return MoveResult.FIVEFOLD
+    elif halfmove_clock >= 150:
+        return MoveResult.SEVENTY_FIVE
+    else:
+        return None
+
+
+def claimable_draw(board, repetitions):
+
+    # Draws a player can claim with /draw
+    if repetitions >= 3:
+        return MoveResult.REPETITION
+    elif board.halfmove_clock >= 100:
+        return MoveResult.FIFTY
+    else:
+        return None
+
+
 def check_move(board, move_code):
 
     chess_move = parse_move(move_code)
 
-    dummy = board.copy()
-
     if not chess_move:
         return MoveResult.UNKNOWN
 
-    if chess_move in board.legal_moves:
+    return position_moves(board).get(chess_move, MoveResult.BAD)
 
-        dummy.push(chess_move)
 
-        if dummy.is_checkmate():
-            return MoveResult.CHECKMATE
-        elif dummy.is_check():
-            return MoveResult.CHECK
-        elif dummy.is_stalemate():
-            return MoveResult.STALEMATE
-        else:
-            return MoveResult.GOOD
+def evaluate(board):
+
+    # Future with the score, best move and depth of the position for the side
+    # to move. The search runs in the engine pool, off the request thread.
+    key = chess.polyglot.zobrist_hash(board)
+
+    cached = evaluations.get(key)
+    if cached:
+        future = Future()
+        future.set_result(cached)
+        return future
+
+    try:
+        future = engine_pool.get().submit(engine.search, board.fen(),
+                                          app.config.get('EVAL_TIME_BUDGET', 2.0),
+                                          app.config.get('EVAL_MAX_DEPTH', 8))
+    except RuntimeError as e:
+        # Broken or shut down pool
+        future = Future()
+        future.set_exception(e)
+        return future
+
+    def store(future):
+        if not future.exception():
+            evaluations.put(key, future.result())
+
+    future.add_done_callback(store)
+
+    return future
+
+
+def format_score(score):
+
+    if abs(score) > engine.MATE - 1000:
+        # Moves to mate
+        plies = engine.MATE - abs(score)
+        return "#{}{}".format("" if score > 0 else "-", (plies + 1)//2)
     else:
-        return MoveResult.BAD
+        return "{:+.2f}".format(score/100)
 
 
 def move(user, move_code):
+    in_transaction(user, play, move_code)
+
+
+def claim_draw(user):
+    in_transaction(user, claim)
+
+
+def transaction(fn, *args):
+
+    # fn(*args) and everything it changes are committed in one transaction,
+    # that runs again on contention. Messages go out once it's committed.
+    def attempt():
+        with dispatcher.hold() as outbox:
+            result = fn(*args)
+        return result, outbox
+
+    result, outbox = session.transaction(attempt,
+                                         retries=app.config.get('TXN_RETRIES', 5),
+                                         backoff=app.config.get('TXN_BACKOFF', 0.05))
+
+    for chat_id, job in outbox.jobs:
+        dispatcher.submit_job(chat_id, job)
+
+    return result
+
+
+def in_transaction(user, fn, *args):
+
+    # fn(player, *args) in a transaction, with the match and the player read
+    # again in it
+    user_id, match_id = user.key.id(), user.match_id
+
+    def attempt():
+        match = session.get(data.Match, match_id) if match_id else None
+        player = data.get_player(match, user_id) if match else None
+        if not player or player.match_id != match_id:
+            logging.info("Match %s of user %s is over, %s dropped", match_id, user_id, fn.__name__)
+        else:
+            fn(player, *args)
+
+    transaction(attempt)
+
+
+def play(user, move_code):
 
     adversary = user.get_adversary()
     match = user.get_match()
-    # TODO: Check if Null
 
     # Check if it's the user's turn to move
     if not match.is_user_turn(user):
@@ -67,10 +234,9 @@ def move(user, move_code):
 
     if int(move_result) >= 0:
 
-        user.send_photo(photo=match.get_board_img(user))
-        adversary.send_photo(
-            photo=match.get_board_img(adversary),
-            caption=user.username + " responded!")
+        data.send_boards(match, [
+            (user, {}),
+            (adversary, {"caption": user.username + " responded!"})])
 
         if move_result == MoveResult.CHECKMATE:
 
@@ -85,21 +251,14 @@ def move(user, move_code):
                 constants.STRING_GAME_CHECKMATE_LOSE.format(user.username))
             adversary.send_message(constants.STRING_GAME_END)
 
-            # Delete match
+            # Archive match
             if match:
-                match.key.delete()
+                archive.archive_match(match, [user, adversary], Termination.CHECKMATE, winner=user)
 
-        elif move_result == MoveResult.STALEMATE:
+        elif move_result in DRAW_STRINGS:
 
-            # Stale mate
-            user.send_message(constants.STRING_GAME_STALEMATE)
-            user.end_game(GameResult.DRAW)
-            adversary.send_message(constants.STRING_GAME_STALEMATE)
-            adversary.end_game(GameResult.DRAW)
-
-            # Delete match
-            if match:
-                match.key.delete()
+            # Stalemate or draw
+            end_draw(user, adversary, match, move_result)
 
         else:
 
@@ -110,9 +269,45 @@ def move(user, move_code):
             user.send_message(
                 constants.STRING_GAME_TURN_WAIT.format(adversary.username))
             adversary.send_message(constants.STRING_GAME_TURN_YOUR)
+
+            # Tell the players once a draw can be claimed
+            board = match.get_board()
+            repetitions = match.get_repetitions()
+            if claimable_draw(board, repetitions) and (repetitions == 3 or board.halfmove_clock == 100):
+                user.send_message(constants.STRING_GAME_DRAW_CLAIMABLE)
+                adversary.send_message(constants.STRING_GAME_DRAW_CLAIMABLE)
+
+            if isinstance(adversary, data.EngineUser):
+                computer.schedule(match)
     else:
         # Error
         if move_result == MoveResult.BAD:
             user.send_message(constants.ERROR_MOVE_BAD)
         elif move_result == MoveResult.UNKNOWN:
             user.send_message(constants.ERROR_MOVE_UNKNOWN)
+
+
+def claim(user):
+
+    adversary = user.get_adversary()
+    match = user.get_match()
+
+    result = claimable_draw(match.get_board(), match.get_repetitions())
+    if not result:
+        user.send_message(constants.ERROR_DRAW_CLAIM)
+        return
+
+    adversary.send_message(constants.STRING_GAME_DRAW_CLAIMED.format(user.username))
+    end_draw(user, adversary, match, result)
+
+
+def end_draw(user, adversary, match, result):
+
+    user.send_message(DRAW_STRINGS[result])
+    user.end_game(GameResult.DRAW)
+    adversary.send_message(DRAW_STRINGS[result])
+    adversary.end_game(GameResult.DRAW)
+
+    # Archive match
+    if match:
+        archive.archive_match(match, [user, adversary], Termination[result.name])
@@ -0,0 +1,70 @@
+import struct
+import chess
+
+
+# Moves are stored as big endian 16 bit codes:
+#   bits 0-5   to square
+#   bits 6-11  from square
+#   bits 12-14 promotion piece type (0 for none)
+MOVE_FORMAT = ">H"
+MOVE_SIZE = struct.calcsize(MOVE_FORMAT)
+
+# A FEN checkpoint is stored every CHECKPOINT_INTERVAL plies, so that a
+# position is rebuilt replaying at most that many moves. Changing it breaks
+# the checkpoints of the stored matches.
+CHECKPOINT_INTERVAL = 32
+
+
+def encode(move):
+    return (move.promotion or 0) << 12 | move.from_square << 6 | move.to_square
+
+
+def decode(code):
+    return chess.Move((code >> 6) & 0x3f, code & 0x3f, (code >> 12) & 0x7 or None)
+
+
+def append(moves, move):
+    return (moves or b"") + struct.pack(MOVE_FORMAT, encode(move))
+
+
+def length(moves):
+    return len(moves or b"")//MOVE_SIZE
+
+
+def unpack(moves, start=0, stop=None):
+    # Decodes the moves from ply start to ply stop
+    data = (moves or b"")[start*MOVE_SIZE:None if stop is None else stop*MOVE_SIZE]
+    return [decode(code) for (code,) in struct.iter_unpack(MOVE_FORMAT, data)]
+
+
+# Positions seen since the last irreversible move, as big endian pairs of
+# Zobrist hash and number of occurrences
+COUNT_FORMAT = ">QB"
+COUNT_SIZE = struct.calcsize(COUNT_FORMAT)
+
+
+def unpack_counts(counts):
+    return dict(struct.iter_unpack(COUNT_FORMAT, counts or b""))
+
+
+def pack_counts(counts):
+    return b"".join(struct.pack(COUNT_FORMAT, key, min(count, 0xff)) for key, count in counts.items())
+
+
+def is_checkpoint(ply):
+    return ply > 0 and ply % CHECKPOINT_INTERVAL == 0
+
+
+def board_at(start_fen, moves, checkpoints, ply):
+
+    # Start from the closest checkpoint before ply
+    index = min(ply//CHECKPOINT_INTERVAL, len(checkpoints or ()))
+    if index:
+        board = chess.Board(checkpoints[index - 1])
+    else:
+        board = chess.Board(start_fen)
+
+    for move in unpack(moves, index*CHECKPOINT_INTERVAL, ply):
+        board.push(move)
+
+    return board
@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
+from cache import LRUCache
+
+
+_local = threading.local()
+
+
+class Reroute(Exception):
+
+    # Raised by a call that finds it runs in the wrong lane, the call goes to
+    # the back of the right one. Nothing it did must be stored.
+
+    def __init__(self, key):
+        super().__init__(key)
+        self.key = key
+
+
+class Call(object):
+
+    def __init__(self, key, fn, args, kwargs, sender):
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.sender = sender
+        self.future = Future()
+        self.queued = time.perf_counter()
+
+
+class LaneScheduler(object):
+
+    # Calls that touch the same state share a lane: ("match", match_id) or
+    # ("user", user_id) for users without a match. The calls of a lane run
+    # one at a time in order, different lanes run in parallel on the pool.
+    #
+    # The calls of a sender (the user an update comes from) keep their order
+    # when they move between lanes: only one of them is in a lane at a time,
+    # the next one enters the last lane the sender was seen in once it's done.
+
+    def __init__(self, workers=16, max_routes=100000):
+
+        self.workers = workers
+
+        # Last known lane by sender, a hint checked by the call itself
+        self.routes = LRUCache(max_items=max_routes)
+
+        self._lanes = {}
+        self._senders = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def submit(self, key, fn, *args, sender=None, **kwargs):
+        call = Call(key, fn, args, kwargs, sender)
+
+        with self._lock:
+            if sender is None:
+                self._append(key, call)
+            elif sender in self._senders:
+                self._senders[sender].append(call)
+            else:
+                self._senders[sender] = deque()
+                self._append(self.routes.get(sender, key), call)
+
+        return call.future
+
+    def route(self, sender, key):
+        self.routes.put(sender, key)
+
+    def pending(self, key):
+        with self._lock:
+            return len(self._lanes.get(key, ()))
+
+    def _append(self, key, call):
+        # Called with the lock held
+        if key in self._lanes:
+            self._lanes[key].append(call)
+        else:
+            self._lanes[key] = deque([call])
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="lane")
+            self._executor.submit(self._run, key)
+
+    def _run(self, key):
+
+        with self._lock:
+            call = self._lanes[key][0]
+
+        metrics.lane_wait.observe(time.perf_counter() - call.queued)
+        _local.lane = (self, key)
+        try:
+            result, error = call.fn(*call.args, **call.kwargs), None
+        except Reroute as e:
+            logging.debug("Call moved from lane %s to %s", key, e.key)
+            metrics.lane_reroutes.inc()
+            with self._lock:
+                self._lanes[key].popleft()
+                self._append(e.key, call)
+                self._next(key)
+            return
+        except BaseException as e:
+            result, error = None, e
+        finally:
+            _local.lane = None
+
+        with self._lock:
+            self._lanes[key].popleft()
+            if call.sender is not None:
+                waiting = self._senders[call.sender]
+                if waiting:
+                    following = waiting.popleft()
+                    self._append(self.routes.get(call.sender, following.key), following)
+                else:
+                    del self._senders[call.sender]
+            self._next(key)
+
+        if error is not None:
+            call.future.set_exception(error)
+        else:
+            call.future.set_result(result)
+
+    def _next(self, key):
+        # Called with the lock held. One call per turn, so that a busy lane
+        # doesn't hold a worker while other lanes wait.
+        if self._lanes[key]:
+            self._executor.submit(self._run, key)
+        else:
+            del self._lanes[key]
+
+
+def check(key, sender=None):
+
+    # Called once the state a call touches is known. Raises Reroute if the
+    # call runs in another lane, and records the lane of the sender.
+    lane = getattr(_local, "lane", None)
+    if lane is None:
+        return
+
+    scheduler, current_key = lane
+    if current_key != key:
+        raise Reroute(key)
+
+    if sender is not None:
+        scheduler.route(sender, key)
+
+
+def route(sender, key):
+    # Records the lane the next calls of the sender should start in
+    lane = getattr(_local, "lane", None)
+    if lane is not None:
+        lane[0].route(sender, key)
+
+
+def create(config):
+    return LaneScheduler(workers=config.get('LANE_WORKERS', 16))
@@ -1,13 +1,24 @@
-from shared import app, bot
+import startup
+startup.begin()
 
-from datetime import datetime
+from shared import app, bot, dispatcher, log_client, ndb_client, scheduler
+
+from datetime import datetime, timedelta
+import hmac
 import logging
 import flask
 import telegram
 import constants
-from data import User
+import chess
+from data import User, UsernameIndex, render_board, emojize
 import commands
-from maintainance import task_users, task_matches
+import dedup
+import game
+import lanes
+import metrics
+import pgn
+import session
+from maintainance import task_users, task_updates, task_matches
 
 
 @app.route(app.config['BOT_HOOK'], methods=['POST'])
@@ -17,49 +28,142 @@ def webhook_handler():
         # Retrieve the message in JSON and then transform it to Telegram object
         update = telegram.Update.de_json(flask.request.get_json(force=True), bot)
 
-        if update.message:
-            # Regular message
-            text = update.message.text
-            user_id = update.message.from_user.id
-            chat_id = update.message.chat_id
-            username = update.message.from_user.username
-            message_id = None
-        elif update.callback_query:
-            # Callback query
-            text = update.callback_query.data
-            user_id = update.callback_query.from_user.id
-            chat_id = update.callback_query.message.chat_id
-            username = update.callback_query.from_user.username
-            message_id = update.callback_query.message.message_id
-        else:
-            logging.error("Received unknown update!")
-            return constants.RESPONSE_OK
-
-        # User must have username
-        if not username:
-            bot.sendMessage(chat_id, constants.ERROR_NO_USERNAME)
-            return constants.RESPONSE_OK
-
-        # Retrieve/Create user
-        user = User.get_by_id(user_id)
-        if not user:
-            # New user
-            logging.info("User %s not found! Creating new user...", user_id)
-            user = User(id=user_id, chat_id=chat_id, username=username)
-            user.put()
-        else:
-            # Existing user
-            user.last_activity_date = datetime.now()
-            if username != user.username:
-                logging.debug("User %s has changed username from %s to %s", user_id, user.username, username)
-                user.username = username
-            user.put()
-
-        commands.handle_input(user, text, message_id)
+        processed = submit_update(update, run_update).result()
+        if processed:
+            # The last message to the user can be the reply to the webhook
+            outbox, chat_id = processed
+            reply = outbox.release(dispatcher, chat_id)
+            if reply:
+                return flask.jsonify(reply)
 
         return constants.RESPONSE_OK
 
 
+def update_user(update):
+    if update.message and update.message.from_user:
+        return update.message.from_user.id
+    elif update.callback_query:
+        return update.callback_query.from_user.id
+    else:
+        return None
+
+
+def lane_key(user):
+    # Updates of users in a match are ordered with those of the adversary
+    if user.match_id:
+        return ("match", user.match_id)
+    else:
+        return ("user", user.key.id())
+
+
+def submit_update(update, fn, *args):
+    # Runs fn(update, *args) in the lane of the update, returns its future.
+    # The lane of the user is a guess until the user is read, see
+    # handle_update.
+
+    user_id = update_user(update)
+    if user_id:
+        key = ("user", user_id)
+    else:
+        key = ("update", update.update_id)
+
+    return scheduler.submit(key, fn, update, *args, sender=user_id)
+
+
+def run_update(update):
+    # Runs in a lane, out of the request's context
+    log_client.get()
+    with ndb_client.context(), session.scope(app.config.get('UOW_TRANSACTIONAL', False)):
+        return process_update(update)
+
+
+def process_update(update):
+    # Handles the update and stores its changes. Returns the outbox with the
+    # messages to send and the chat of the update, None for duplicates.
+
+    # Telegram sends again the updates acknowledged late
+    if not dedup.claim(update.update_id):
+        logging.info("Update %s already processed", update.update_id)
+        return None
+
+    # Messages go out once the new state is stored
+    try:
+        with dispatcher.hold() as outbox:
+            chat_id = handle_update(update)
+            session.flush()
+    except Exception:
+        dedup.release(update.update_id)
+        raise
+
+    return outbox, chat_id
+
+
+def handle_update(update):
+    # Returns the chat the update came from
+
+    if update.message:
+        # Regular message
+        text = update.message.text
+        user_id = update.message.from_user.id
+        chat_id = update.message.chat_id
+        username = update.message.from_user.username
+        message_id = None
+    elif update.callback_query:
+        # Callback query
+        text = update.callback_query.data
+        user_id = update.callback_query.from_user.id
+        chat_id = update.callback_query.message.chat_id
+        username = update.callback_query.from_user.username
+        message_id = update.callback_query.message.message_id
+    else:
+        logging.error("Received unknown update!")
+        return
+
+    # User must have username
+    if not username:
+        dispatcher.submit(chat_id, bot.send_message, chat_id, constants.ERROR_NO_USERNAME)
+        return chat_id
+
+    # Retrieve/Create user
+    user = session.get(User, user_id)
+
+    if user and (username != user.username or
+                 datetime.now() - user.last_activity_date > timedelta(hours=1)):
+        # Existing user, touched in a transaction: an invite from the lane of
+        # another user may have changed it since it was read. The user read
+        # above gets the committed state. The activity only matters to the
+        # USER_TIMEOUT days of task_users, it's stored once an hour at most.
+        game.transaction(touch_user, user_id, username)
+
+    # Nothing else is changed before the update is in the lane of its state
+    lanes.check(lane_key(user) if user else ("user", user_id), user_id)
+
+    if not user:
+        # New user
+        logging.info("User %s not found! Creating new user...", user_id)
+        user = User(id=user_id, chat_id=chat_id, username=username)
+        session.save(user)
+        UsernameIndex.register(user)
+
+    commands.handle_input(user, text, message_id)
+
+    lanes.route(user_id, lane_key(user))
+
+    return chat_id
+
+
+def touch_user(user_id, username):
+
+    user = session.get(User, user_id)
+    user.last_activity_date = datetime.now()
+    if username != user.username:
+        logging.debug("User %s has changed username from %s to %s", user_id, user.username, username)
+        old_username = user.username
+        user.username = username
+        UsernameIndex.register(user, old_username)
+    session.save(user)
+
+
 @app.route('/set_webhook', methods=['GET', 'POST'])
 def set_webhook():
 
@@ -75,9 +179,29 @@ def set_webhook():
         return constants.RESPONSE_FAIL
 
 
+def is_admin_request():
+    # HTTP basic auth with the admin password, any username
+    password = app.config.get('ADMIN_PASS')
+    auth = flask.request.authorization
+    return bool(password and auth and hmac.compare_digest((auth.password or "").encode(), password.encode()))
+
+
+def admin_auth_required():
+    return flask.Response(constants.RESPONSE_FAIL, 401, {"WWW-Authenticate": 'Basic realm="Chess Duel Bot"'})
+
+
+@app.route('/metrics')
+def metrics_handler():
+    if not is_admin_request():
+        return admin_auth_required()
+
+    return flask.Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route('/tasks/maintain_users', methods=['GET', 'POST'])
 def maintain_users():
     task_users()
+    task_updates()
     return constants.RESPONSE_OK
 
 
@@ -87,6 +211,43 @@ def maintain_matches():
     return constants.RESPONSE_OK
 
 
+@app.route('/admin/export.pgn')
+def export_pgn():
+
+    if not is_admin_request():
+        return admin_auth_required()
+
+    page_size = app.config.get('EXPORT_PAGE_SIZE', 10)
+
+    def generate():
+        # Streamed after the request is done, out of the middleware's context
+        with ndb_client.context():
+            yield from pgn.export_archive(page_size)
+
+    return flask.Response(generate(), mimetype="application/x-chess-pgn",
+                          headers={"Content-Disposition": "attachment; filename=chess-duel.pgn"})
+
+
+@app.route('/_ah/warmup')
+def warmup():
+
+    # Build clients and load the renderer before the first user request
+    bot.get()
+    ndb_client.get()
+    log_client.get()
+    emojize(constants.STRING_GAME_CHECK)
+    board = chess.Board()
+    for flipped in (False, True):
+        render_board(board, flipped, None)
+
+    logging.info(startup.report())
+
+    return constants.RESPONSE_OK
+
+
 @app.route('/')
 def index():
     return constants.RESPONSE_OK
+
+
+startup.end()
@@ -2,7 +2,14 @@ from shared import app
 
 import humanfriendly
 import logging
-from data import User, Match, GameResult
+import time
+from google.cloud import ndb
+import archive
+import computer
+import game
+import session
+from archive import Termination
+from data import UserStatus, User, EngineUser, Match, TaskCheckpoint, ProcessedUpdate, GameResult, get_player
 import constants
 from datetime import datetime, timedelta
 
@@ -11,56 +18,158 @@ def task_users():
 
     logging.info("Performing user maintainance...")
 
-    users = list(User.query().fetch())
-
-    for user in users:
-        # Delete all users whose last move is older than USER_TIMEOUT
-        expired = (datetime.now() - user.last_activity_date) > timedelta(days=app.config['USER_TIMEOUT'])
-        if expired:
-            # Delete user
-            logging.info("Deleting user %s. Last activity: %s", user.username, str(user.last_activity_date))
-            user.key.delete()
+    # Resume the previous run if it didn't complete
+    checkpoint = TaskCheckpoint.get_by_id("users")
+    if checkpoint and checkpoint.cursor:
+        logging.info("Resuming user maintainance from %s", str(checkpoint.update_date))
+        cursor = ndb.Cursor(urlsafe=checkpoint.cursor)
+        cutoff = checkpoint.cutoff
+    else:
+        checkpoint = TaskCheckpoint(id="users")
+        cursor = None
+        cutoff = datetime.now() - timedelta(days=app.config['USER_TIMEOUT'])
+
+    # Delete all idle users whose last activity is older than USER_TIMEOUT
+    query = User.query(User.status == UserStatus.IDLE, User.last_activity_date < cutoff)
+    page_size = app.config.get('TASK_PAGE_SIZE', 100)
+    time_budget = app.config.get('TASK_TIME_BUDGET', 60)
+
+    start = time.monotonic()
+    deleted = 0
+    more = True
+    while more:
+        keys, cursor, more = query.fetch_page(page_size, keys_only=True, start_cursor=cursor)
+
+        ndb.delete_multi(keys)
+        deleted += len(keys)
+
+        if more and time.monotonic() - start > time_budget:
+            # Out of time, save where to start next time
+            checkpoint.cursor = cursor.urlsafe().decode()
+            checkpoint.cutoff = cutoff
+            checkpoint.put()
+            logging.info("Deleted %d users, user maintainance will resume on the next run", deleted)
+            return
+
+    if checkpoint.key and checkpoint.cursor:
+        checkpoint.key.delete()
+
+    logging.info("Deleted %d users", deleted)
+
+
+def task_updates():
+
+    logging.info("Purging processed updates...")
+
+    query = ProcessedUpdate.query(ProcessedUpdate.expire_date < datetime.now())
+    page_size = app.config.get('TASK_PAGE_SIZE', 100)
+
+    cursor = None
+    more = True
+    while more:
+        keys, cursor, more = query.fetch_page(page_size, keys_only=True, start_cursor=cursor)
+        ndb.delete_multi(keys)
+
+
+def backfill_deadlines():
+
+    # Matches stored before deadline was added don't have it in the index,
+    # they are stored again once. Runs until done over the next task runs.
+    checkpoint = TaskCheckpoint.get_by_id("deadlines")
+    if checkpoint and not checkpoint.cursor:
+        return
+
+    if checkpoint:
+        cursor = ndb.Cursor(urlsafe=checkpoint.cursor)
+    else:
+        checkpoint = TaskCheckpoint(id="deadlines")
+        cursor = None
+
+    query = Match.query()
+    page_size = app.config.get('TASK_PAGE_SIZE', 100)
+    time_budget = app.config.get('TASK_TIME_BUDGET', 60)
+
+    start = time.monotonic()
+    more = True
+    while more:
+        keys, cursor, more = query.fetch_page(page_size, keys_only=True, start_cursor=cursor)
+
+        # Read and written in a transaction not to undo a concurrent move,
+        # at most 25 entity groups each
+        for i in range(0, len(keys), 25):
+            chunk = keys[i:i + 25]
+            ndb.transaction(lambda: ndb.put_multi([match for match in ndb.get_multi(chunk, use_cache=False) if match],
+                                                  use_cache=False))
+
+        if more and time.monotonic() - start > time_budget:
+            checkpoint.cursor = cursor.urlsafe().decode()
+            checkpoint.put()
+            logging.info("Match deadline backfill will resume on the next run")
+            return
+
+    # Done, the checkpoint without a cursor says so
+    checkpoint.cursor = None
+    checkpoint.put()
+    logging.info("Match deadline backfill done")
 
 
 def task_matches():
 
     logging.info("Performing match maintainance...")
 
-    matches = list(Match.query().fetch())
+    backfill_deadlines()
+
+    now = datetime.now()
+    query = Match.query(Match.deadline < now)
+    page_size = app.config.get('TASK_PAGE_SIZE', 100)
+
+    cursor = None
+    more = True
+    while more:
+        keys, cursor, more = query.fetch_page(page_size, keys_only=True, start_cursor=cursor)
+
+        # Each match expires in a transaction, that reads it again: a move
+        # committed since the query isn't lost
+        for key in keys:
+            game.transaction(expire_match, key.id(), now)
+
 
-    for match in matches:
+def expire_match(match_id, now):
 
-        # Delete all matches whose last move is older than the specified timeout
-        if match.last_move_date:
-            expired = (datetime.now() - match.last_move_date) > timedelta(seconds=match.timeout)
-        else:
-            expired = False
+    # Skip matches moved since the query
+    match = session.get(Match, match_id)
+    if not match or not match.deadline or match.deadline >= now:
+        return
 
-        if expired:
+    white = get_player(match, match.white_id)
+    black = get_player(match, match.black_id)
 
-            white = User.get_by_id(match.white_id)
-            black = User.get_by_id(match.black_id)
+    if match.is_user_turn(white):
+        looser = white
+        winner = black
+    else:
+        winner = white
+        looser = black
 
-            if match.is_user_turn(white):
-                looser = white
-                winner = black
-            else:
-                winner = white
-                looser = black
+    if isinstance(looser, EngineUser):
+        # The computer reply was lost, queue it again
+        logging.info("Computer move of match %s is late, retrying", match.key.id())
+        computer.schedule(match)
+        return
 
-            white.send_message(constants.ERROR_TIMEOUT.format(
-                looser.username,
-                humanfriendly.format_timespan(match.timeout)))
-            black.send_message(constants.ERROR_TIMEOUT.format(
-                looser.username,
-                humanfriendly.format_timespan(match.timeout)))
+    white.send_message(constants.ERROR_TIMEOUT.format(
+        looser.username,
+        humanfriendly.format_timespan(match.timeout)))
+    black.send_message(constants.ERROR_TIMEOUT.format(
+        looser.username,
+        humanfriendly.format_timespan(match.timeout)))
 
-            winner.end_game(GameResult.WIN)
-            looser.end_game(GameResult.LOSE)
+    winner.end_game(GameResult.WIN)
+    looser.end_game(GameResult.LOSE)
 
-            # Delete match
-            logging.info("Deleting match %s. Last activity: %s", match.key.id(), str(match.last_move_date))
-            match.key.delete()
+    # Archive match
+    logging.info("Archiving match %s. Last activity: %s", match.key.id(), str(match.last_move_date))
+    archive.archive_match(match, [white, black], Termination.TIMEOUT, winner=winner)
 
 
 def notify_admins(message):
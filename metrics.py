@@ -0,0 +1,131 @@
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Latency buckets in seconds
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + "}"
+
+
+class Counter(object):
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                yield self.name, _format_labels(self.labels, key), value
+
+
+class Histogram(object):
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=TIME_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0]*len(self.buckets), 0, 0]
+            counts, _, _ = entry = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    yield self.name + "_bucket", _format_labels(self.labels, key, [("le", bound)]), bucket_count
+                yield self.name + "_bucket", _format_labels(self.labels, key, [("le", "+Inf")]), count
+                yield self.name + "_sum", _format_labels(self.labels, key), total
+                yield self.name + "_count", _format_labels(self.labels, key), count
+
+
+def render():
+    # Prometheus text exposition format
+    lines = []
+    for metric in _metrics:
+        lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            lines.append("{}{} {}".format(name, labels, value))
+    return "\n".join(lines) + "\n"
+
+
+input_latency = Histogram(
+    "chessduel_input_seconds", "Time to handle a user input.")
+command_latency = Histogram(
+    "chessduel_command_seconds", "Time to run a command, by command and phase (cmd or arg).",
+    labels=("command", "phase"))
+
+datastore_reads = Histogram(
+    "chessduel_request_datastore_reads", "Datastore entity reads per request, those served by the context cache excluded.",
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64))
+datastore_writes = Histogram(
+    "chessduel_request_datastore_writes", "Datastore entity writes and deletes per request.",
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64))
+datastore_transactions = Counter(
+    "chessduel_datastore_transactions_total", "Datastore transaction attempts, by result (committed, conflict, transient or failed).",
+    labels=("result",))
+
+render_latency = Histogram(
+    "chessduel_render_seconds", "Time to rasterize a board image.")
+render_size = Histogram(
+    "chessduel_render_bytes", "Size of the rasterized board images.",
+    buckets=(8192, 16384, 32768, 65536, 131072, 262144))
+
+telegram_latency = Histogram(
+    "chessduel_telegram_seconds", "Telegram API call latency, by method.",
+    labels=("method",))
+telegram_calls = Counter(
+    "chessduel_telegram_calls_total", "Telegram API calls, by method and result.",
+    labels=("method", "result"))
+
+computer_latency = Histogram(
+    "chessduel_computer_seconds", "Time from a move to the computer's reply.")
+
+lane_wait = Histogram(
+    "chessduel_lane_wait_seconds", "Time a call waits in its lane before it runs.")
+lane_reroutes = Counter(
+    "chessduel_lane_reroutes_total", "Calls moved to another lane once their state was known.")
@@ -0,0 +1,46 @@
+import chess
+import chess.pgn
+from archive import ArchiveBatch
+
+
+UNKNOWN_PLAYER = "?"
+
+
+def match_pgn(match, white_name, black_name, result="*"):
+
+    # Works for a Match or an ArchivedGame
+    game = chess.pgn.Game()
+
+    game.headers["Event"] = "Chess Duel"
+    game.headers["Site"] = "Telegram"
+    game.headers["Date"] = match.creation_date.strftime("%Y.%m.%d") if match.creation_date else "????.??.??"
+    game.headers["Round"] = "-"
+    game.headers["White"] = white_name or UNKNOWN_PLAYER
+    game.headers["Black"] = black_name or UNKNOWN_PLAYER
+    game.headers["Result"] = result
+
+    if match.start_fen:
+        game.setup(match.start_fen)
+
+    node = game
+    for move in match.get_moves():
+        node = node.add_variation(move)
+
+    return game.accept(chess.pgn.StringExporter(headers=True, variations=False, comments=False))
+
+
+def export_archive(page_size=100):
+
+    # Yields the PGN of all the archived games a page of batches at a time,
+    # so that the export never holds more than a page in memory. Needs an
+    # ndb context.
+    cursor = None
+    more = True
+    while more:
+        batches, cursor, more = ArchiveBatch.query().fetch_page(page_size, start_cursor=cursor)
+
+        # Games are in the batches of both players, export white's copy
+        yield "".join(match_pgn(game, game.white_name, game.black_name, game.result) + "\n\n"
+                      for batch in batches
+                      for game in batch.get_games()
+                      if game.white_id == batch.user_id)
@@ -0,0 +1,114 @@
+import io
+import logging
+import chess
+
+# chess.svg, cairosvg and PIL are imported on first render, requests that
+# don't render don't pay for them
+
+
+def board_key(board, flipped, lastmove):
+    # Move counters and side to move don't change the picture, the piece
+    # placement does
+    return (board.board_fen(), flipped, lastmove.uci() if lastmove else None)
+
+
+def svg_to_image(svg_string):
+    import cairosvg
+    from PIL import Image
+
+    return Image.open(io.BytesIO(cairosvg.svg2png(svg_string))).convert("RGBA")
+
+
+def render_svg(board, flipped, lastmove):
+    import chess.svg
+    import cairosvg
+
+    # Generate SVG
+    svg_string = chess.svg.board(
+        board=board,
+        flipped=flipped,
+        lastmove=lastmove)
+
+    # Convert SVG to PNG
+    mem_file = io.BytesIO()
+    cairosvg.svg2png(svg_string, write_to=mem_file)
+
+    return mem_file.getvalue()
+
+
+# Composites boards from sprites rasterized once with cairosvg. The output
+# matches render_svg: empty boards (squares and coordinates) and pieces come
+# from the same chess.svg drawings, last move squares use the same colors.
+class SpriteRenderer(object):
+
+    def __init__(self, compress_level=3):
+        import chess.svg
+
+        self.compress_level = compress_level
+
+        # Empty boards, one per orientation
+        self.backgrounds = {}
+        for flipped in (False, True):
+            self.backgrounds[flipped] = svg_to_image(chess.svg.board(board=None, flipped=flipped))
+
+        viewbox = 8*chess.svg.SQUARE_SIZE + 2*chess.svg.MARGIN
+        scale = self.backgrounds[False].width / viewbox
+        self.square_size = round(chess.svg.SQUARE_SIZE*scale)
+        self.margin = round(chess.svg.MARGIN*scale)
+
+        # Pieces
+        self.sprites = {}
+        for color in chess.COLORS:
+            for piece_type in chess.PIECE_TYPES:
+                piece = chess.Piece(piece_type, color)
+                self.sprites[piece.symbol()] = svg_to_image(chess.svg.piece(piece, size=self.square_size))
+
+        logging.info("Sprite renderer ready, %dpx board", self.backgrounds[False].width)
+
+    def square_origin(self, square, flipped):
+
+        file_index = chess.square_file(square)
+        rank_index = chess.square_rank(square)
+
+        x = (file_index if not flipped else 7 - file_index)*self.square_size + self.margin
+        y = (7 - rank_index if not flipped else rank_index)*self.square_size + self.margin
+
+        return x, y
+
+    def render(self, board, flipped, lastmove):
+        import chess.svg
+        from PIL import ImageDraw
+
+        image = self.backgrounds[flipped].copy()
+
+        # Last move
+        if lastmove:
+            draw = ImageDraw.Draw(image)
+            for square in (lastmove.from_square, lastmove.to_square):
+                if chess.BB_LIGHT_SQUARES & chess.BB_SQUARES[square]:
+                    color = chess.svg.DEFAULT_COLORS["square light lastmove"]
+                else:
+                    color = chess.svg.DEFAULT_COLORS["square dark lastmove"]
+                x, y = self.square_origin(square, flipped)
+                draw.rectangle([x, y, x + self.square_size - 1, y + self.square_size - 1], fill=color)
+
+        # Pieces
+        for square, piece in board.piece_map().items():
+            sprite = self.sprites[piece.symbol()]
+            image.alpha_composite(sprite, self.square_origin(square, flipped))
+
+        mem_file = io.BytesIO()
+        image.save(mem_file, format="PNG", compress_level=self.compress_level)
+
+        return mem_file.getvalue()
+
+
+# Returns a function (board, flipped, lastmove) -> PNG bytes
+def get_renderer(name):
+
+    if name == "svg":
+        return render_svg
+    elif name == "raster":
+        return SpriteRenderer().render
+    else:
+        raise ValueError("Unknown renderer " + name)
@@ -0,0 +1,294 @@
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from google.api_core import exceptions
+from google.cloud import ndb
+import metrics
+
+
+_local = threading.local()
+
+
+class Session(object):
+
+    def __init__(self, transactional=False):
+
+        self.transactional = transactional
+
+        # Entities created or changed by the session, None for deleted keys.
+        # Those read are shared through the context cache of ndb, except in
+        # a transaction (see cache_options) where the session keeps them.
+        self.entities = {}
+
+        # Unit of work
+        self.dirty = OrderedDict()
+        self.deleted = OrderedDict()
+
+        # Called once the unit of work is stored
+        self.callbacks = []
+
+        self.reads = 0
+        self.reads_saved = 0
+        self.writes = 0
+        self.writes_saved = 0
+
+    def used(self):
+        return bool(self.entities or self.reads or self.reads_saved or self.writes)
+
+    def get(self, model, id):
+
+        key = ndb.Key(model, id)
+
+        if key in self.entities:
+            self.reads_saved += 1
+            return self.entities[key]
+
+        if ndb.in_transaction():
+            self.reads += 1
+            self.entities[key] = key.get(**cache_options())
+            return self.entities[key]
+
+        # Counted as ndb serves it, from the cache or the Datastore
+        if key in ndb.get_context().cache:
+            self.reads_saved += 1
+        else:
+            self.reads += 1
+
+        return key.get()
+
+    def add(self, entity):
+        self.entities[entity.key] = entity
+
+    def defer(self, fn):
+        self.callbacks.append(fn)
+
+    def save(self, entity):
+        if entity.key in self.dirty:
+            self.writes_saved += 1
+        self.entities[entity.key] = entity
+        self.dirty[entity.key] = entity
+        self.deleted.pop(entity.key, None)
+
+    def delete(self, key):
+        self.entities[key] = None
+        self.dirty.pop(key, None)
+        self.deleted[key] = key
+
+    def flush(self):
+
+        if self.dirty or self.deleted:
+            self._commit()
+
+        callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            fn()
+
+    def _commit(self):
+
+        entities = list(self.dirty.values())
+        keys = list(self.deleted.values())
+
+        def commit():
+            if entities:
+                ndb.put_multi(entities, **cache_options())
+            if keys:
+                ndb.delete_multi(keys, **cache_options())
+
+        if self.transactional:
+            ndb.transaction(commit)
+        else:
+            commit()
+
+        self.writes += len(entities) + len(keys)
+        self.dirty.clear()
+        self.deleted.clear()
+
+
+def current():
+    return getattr(_local, "session", None)
+
+
+def cache_options():
+    # A transaction shares the context cache of the request: what it holds
+    # was read outside the transaction, maybe changed since, and a read it
+    # serves isn't checked at commit. Writes would stay in it if the
+    # transaction fails.
+    return {"use_cache": False} if ndb.in_transaction() else {}
+
+
+@contextmanager
+def scope(transactional=False):
+
+    previous = current()
+    _local.session = Session(transactional)
+
+    try:
+        yield _local.session
+        _local.session.flush()
+    finally:
+        # Scopes nothing ran in, like that of a webhook request whose update
+        # is handled in a lane, would only add empty samples
+        if _local.session.used():
+            metrics.datastore_reads.observe(_local.session.reads)
+            metrics.datastore_writes.observe(_local.session.writes)
+        logging.debug("Session closed, %d datastore reads (%d saved), %d writes (%d saved)",
+                      _local.session.reads, _local.session.reads_saved,
+                      _local.session.writes, _local.session.writes_saved)
+        _local.session = previous
+
+
+def is_contention(error):
+    # Datastore aborts the commit of a transaction whose entities changed
+    # since they were read
+    if isinstance(error, exceptions.Conflict):
+        return True
+    code = getattr(error, "code", None)
+    return callable(code) and getattr(code(), "name", None) == "ABORTED"
+
+
+def is_transient(error):
+    # Errors that leave nothing committed, as google.cloud.ndb retries them
+    if isinstance(error, (exceptions.ServiceUnavailable, exceptions.InternalServerError)):
+        return True
+    code = getattr(error, "code", None)
+    return callable(code) and getattr(code(), "name", None) in ("UNAVAILABLE", "INTERNAL")
+
+
+def transaction(fn, retries=5, backoff=0.05):
+
+    # Runs fn in a datastore transaction, with a session of its own so that
+    # what it reads is checked at commit and what it writes is stored at
+    # once. On contention or a transient error fn runs again in a new
+    # session, up to retries times, after a random delay. Returns what fn
+    # returned in the attempt that committed. Called in a transaction, fn
+    # just runs as part of it.
+    if ndb.in_transaction():
+        return fn()
+
+    outer = current()
+    if outer:
+        # Changes made so far aren't part of the transaction
+        outer.flush()
+
+    sessions = []
+
+    def run():
+        # A new session for each attempt, so that nothing read in one that
+        # failed is used in the next
+        inner = Session()
+        sessions.append(inner)
+        _local.session = inner
+        try:
+            result = fn()
+            if inner.dirty or inner.deleted:
+                inner._commit()
+            return result
+        finally:
+            _local.session = outer
+
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            # Retried here rather than by ndb, to count and delay the attempts
+            result = ndb.transaction(run, retries=0)
+        except Exception as e:
+            if is_contention(e):
+                reason = "conflict"
+            elif is_transient(e):
+                reason = "transient"
+            else:
+                raise
+            if attempt > retries:
+                metrics.datastore_transactions.inc(result="failed")
+                logging.error("Transaction failed after %d attempts: %s", attempt, e)
+                raise
+            metrics.datastore_transactions.inc(result=reason)
+            delay = random.uniform(0, backoff*2**(attempt - 1))
+            logging.info("Transaction %s (%s), retrying in %.3f seconds", reason, e, delay)
+            time.sleep(delay)
+            continue
+
+        metrics.datastore_transactions.inc(result="committed")
+        break
+
+    inner = sessions[-1]
+
+    if outer:
+        outer.reads += inner.reads
+        outer.reads_saved += inner.reads_saved
+        outer.writes += inner.writes
+        outer.writes_saved += inner.writes_saved
+
+    # Instances the context cache and the caller hold get the committed state,
+    # the cache gets those it didn't have
+    cache = ndb.get_context().cache
+    for key, entity in inner.entities.items():
+        for held in (cache, outer.entities if outer else {}):
+            instance = held.get(key)
+            if entity is not None and instance is not None:
+                if instance is not entity:
+                    computed = [name for name, prop in entity._properties.items() if isinstance(prop, ndb.ComputedProperty)]
+                    instance.populate(**entity.to_dict(exclude=computed))
+            elif held is cache or key in held:
+                held[key] = entity
+
+    for callback in inner.callbacks:
+        callback()
+
+    return result
+
+
+def get(model, id):
+    # Every code path of a request shares the same instance of an entity
+    s = current()
+    if s:
+        return s.get(model, id)
+    else:
+        return model.get_by_id(id)
+
+
+def add(entity):
+    s = current()
+    if s:
+        s.add(entity)
+
+
+def flush():
+    s = current()
+    if s:
+        s.flush()
+
+
+def defer(fn):
+    # Runs fn once the changes made so far are stored
+    s = current()
+    if s:
+        s.defer(fn)
+    else:
+        fn()
+
+
+def save(entity):
+    # Entities without a key are written right away to get one. Transient
+    # entities are never written.
+    if getattr(entity, "transient", False):
+        return
+
+    s = current()
+    if s and entity.key:
+        s.save(entity)
+    else:
+        entity.put(**cache_options())
+        add(entity)
+
+
+def delete(key):
+    s = current()
+    if s:
+        s.delete(key)
+    else:
+        key.delete()
@@ -1,27 +1,67 @@
+import threading
 import flask
 import telegram
+import dispatch
+import lanes
+import session
 
-import google.cloud.logging
 import google.cloud.ndb
 
 
+class Lazy(object):
+
+    # Builds the wrapped object on first use, so that new instances don't pay
+    # for clients they don't need yet
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._object = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._object is None:
+            with self._lock:
+                if self._object is None:
+                    self._object = self._factory()
+        return self._object
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
 def ndb_wsgi_middleware(wsgi_app):
     def middleware(environ, start_response):
-        with ndb_client.context():
+        log_client.get()
+        with ndb_client.context(), session.scope(app.config.get('UOW_TRANSACTIONAL', False)):
             return wsgi_app(environ, start_response)
 
     return middleware
 
 
-ndb_client = google.cloud.ndb.Client()
+def create_log_client():
+    import google.cloud.logging
 
-log_client = google.cloud.logging.Client()
-log_client.setup_logging()
+    client = google.cloud.logging.Client()
+    client.setup_logging()
+
+    return client
+
+
+ndb_client = Lazy(google.cloud.ndb.Client)
+
+log_client = Lazy(create_log_client)
 
 global app
 app = flask.Flask(__name__)
 app.config.from_pyfile('main.cfg', silent=True)
+app.config.from_envvar('CHESS_DUEL_SETTINGS', silent=True)
 app.wsgi_app = ndb_wsgi_middleware(app.wsgi_app)
 
 global bot
-bot = telegram.Bot(token=app.config['BOT_TOKEN'])
+bot = Lazy(lambda: telegram.Bot(token=app.config['BOT_TOKEN']))
+
+global dispatcher
+dispatcher = dispatch.create(app.config)
+
+global scheduler
+scheduler = lanes.create(app.config)
@@ -0,0 +1,58 @@
+import builtins
+import os
+import sys
+import time
+
+
+# Import time per module, enabled with the STARTUP_PROFILE environment
+# variable. Times are inclusive (cumulative) and self (without nested
+# imports), like python -X importtime.
+
+_start = time.perf_counter()
+_end = None
+
+_timings = {}
+_stack = []
+_original_import = builtins.__import__
+
+
+def _profiled_import(name, globals=None, locals=None, fromlist=(), level=0):
+
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+
+    _stack.append(0)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = _stack.pop()
+        if _stack:
+            _stack[-1] += elapsed
+        if name not in _timings:
+            _timings[name] = (elapsed, elapsed - nested)
+
+
+def begin():
+    if os.environ.get("STARTUP_PROFILE"):
+        builtins.__import__ = _profiled_import
+
+
+def end():
+    global _end
+    _end = time.perf_counter()
+    builtins.__import__ = _original_import
+
+
+def report(limit=30):
+
+    lines = ["Startup took {:.0f} ms".format(((_end or time.perf_counter()) - _start)*1000)]
+
+    if _timings:
+        lines.append("{:>10} {:>10}  module".format("self ms", "total ms"))
+        ranked = sorted(_timings.items(), key=lambda item: item[1][0], reverse=True)
+        for name, (total, own) in ranked[:limit]:
+            lines.append("{:>10.1f} {:>10.1f}  {}".format(own*1000, total*1000, name))
+
+    return "\n".join(lines)
@@ -0,0 +1,360 @@
+# Transactions against the in-memory Datastore of benchmarks/fakes.py:
+#
+#   python -m unittest tests.test_transactions
+
+import json
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from benchmarks import fakes
+
+fakes.install()
+
+from google.api_core import exceptions
+
+
+CONFIG = """\
+BOT_TOKEN = "0:fake"
+BOT_HOOK = "/hook"
+BOT_HOST = "localhost"
+USER_TIMEOUT = 365
+ASYNC_SEND = False
+TXN_BACKOFF = 0
+"""
+
+
+def setUpModule():
+    global main, data, maintainance, metrics, session, constants, ndb_client, Script, Player
+
+    with tempfile.NamedTemporaryFile("w", suffix=".cfg", delete=False) as config:
+        config.write(CONFIG)
+    os.environ["CHESS_DUEL_SETTINGS"] = config.name
+
+    import main
+    import data
+    import maintainance
+    import metrics
+    import session
+    import constants
+    from shared import ndb_client
+    from benchmarks.loadtest import Script, Player
+
+    os.unlink(config.name)
+
+
+def transactions(result):
+    return metrics.datastore_transactions.values.get((result,), 0)
+
+
+@contextmanager
+def request():
+    # As a webhook request: a context, with its cache, and a session
+    with ndb_client.context(), session.scope():
+        yield
+
+
+def stored_user(user_id):
+    with ndb_client.context():
+        return data.User.get_by_id(user_id)
+
+
+class SessionTransactionTest(unittest.TestCase):
+
+    def setUp(self):
+        fakes.reset()
+        with request():
+            session.save(data.User(id=1, username="player1", chat_id=1))
+
+    def test_conflict_runs_again_on_fresh_state(self):
+
+        attempts = []
+        deferred = []
+
+        def concurrent_write():
+            with ndb_client.context():
+                user = data.User.get_by_id(1)
+                user.win_count = 10
+                user.put()
+
+        def fn():
+            user = session.get(data.User, 1)
+            attempts.append(user)
+            if len(attempts) == 1:
+                # Another client writes between the read and the commit
+                thread = threading.Thread(target=concurrent_write)
+                thread.start()
+                thread.join()
+            user.win_count += 1
+            session.save(user)
+            session.defer(lambda: deferred.append(True))
+
+        conflicts = transactions("conflict")
+        with request():
+            # In the context cache, the transaction must read it again
+            held = session.get(data.User, 1)
+            session.transaction(fn, backoff=0)
+
+            # The instance of the outer session has the committed state
+            self.assertEqual(held.win_count, 11)
+            self.assertIs(session.get(data.User, 1), held)
+
+        self.assertEqual(len(attempts), 2)
+        self.assertIsNot(attempts[0], attempts[1])
+        self.assertEqual(transactions("conflict"), conflicts + 1)
+        self.assertEqual(deferred, [True])
+        self.assertEqual(stored_user(1).win_count, 11)
+
+    def test_reads_ignore_changes_made_outside(self):
+
+        seen = []
+
+        def fn():
+            user = session.get(data.User, 1)
+            seen.append(user.win_count)
+            user.loss_count += 1
+            session.save(user)
+
+        with request():
+            held = session.get(data.User, 1)
+            held.win_count = 99
+            session.transaction(fn, backoff=0)
+
+            self.assertEqual((held.win_count, held.loss_count), (0, 1))
+
+        self.assertEqual(seen, [0])
+        self.assertEqual(stored_user(1).win_count, 0)
+
+    def test_transient_error_runs_again_in_a_new_session(self):
+
+        attempts = []
+
+        def fn():
+            user = session.get(data.User, 1)
+            attempts.append(user.win_count)
+            user.win_count += 1
+            session.save(user)
+
+        fakes.fail_commits.append(exceptions.ServiceUnavailable("unavailable"))
+        with request():
+            session.get(data.User, 1)
+            session.transaction(fn, backoff=0)
+
+        # The second attempt doesn't see the changes of the first
+        self.assertEqual(attempts, [0, 0])
+        self.assertEqual(stored_user(1).win_count, 1)
+
+    def test_gives_up_after_retries(self):
+
+        def fn():
+            user = session.get(data.User, 1)
+            user.win_count += 1
+            session.save(user)
+
+        failed = transactions("failed")
+        fakes.fail_commits.extend(exceptions.Aborted("contention") for i in range(3))
+        with request():
+            with self.assertRaises(exceptions.Aborted):
+                session.transaction(fn, retries=2, backoff=0)
+
+            # Nothing of the failed attempts is left in the context cache
+            self.assertEqual(session.get(data.User, 1).win_count, 0)
+
+        self.assertEqual(transactions("failed"), failed + 1)
+        self.assertEqual(stored_user(1).win_count, 0)
+
+    def test_nested_transaction_joins(self):
+
+        def inner():
+            user = session.get(data.User, 1)
+            user.loss_count += 1
+            session.save(user)
+
+        def outer():
+            inner_result = session.transaction(inner)
+            user = session.get(data.User, 1)
+            user.win_count += 1
+            session.save(user)
+            return inner_result
+
+        with request():
+            session.transaction(outer, backoff=0)
+
+        user = stored_user(1)
+        self.assertEqual((user.win_count, user.loss_count), (1, 1))
+
+    def test_claimed_update_survives_a_transient_error(self):
+
+        fakes.fail_commits.append(exceptions.ServiceUnavailable("unavailable"))
+        with ndb_client.context():
+            self.assertTrue(data.ProcessedUpdate.claim(1, 60))
+            self.assertFalse(data.ProcessedUpdate.claim(1, 60))
+
+
+class MoveTransactionTest(unittest.TestCase):
+
+    def setUp(self):
+        fakes.reset()
+
+        self.replies = []
+        self.client = main.app.test_client()
+
+        self.white = Player(10)
+        self.black = Player(11)
+        self.script = Script(self.white, self.black, [], None)
+
+        # Up to the accepted invitation
+        for update in list(self.script.updates())[:-1]:
+            self.post(update)
+
+    def post(self, update):
+        response = self.client.post("/hook", data=json.dumps(update), content_type="application/json")
+        if response.is_json:
+            self.replies.append(response.get_json().get("text"))
+
+    def test_transient_error_on_commit_keeps_the_move(self):
+
+        fakes.fail_commits.append(exceptions.ServiceUnavailable("unavailable"))
+        self.post(self.script.message(self.white, "e2e4"))
+        self.post(self.script.callback(self.white, "/accept"))
+
+        with request():
+            match = session.get(data.Match, session.get(data.User, self.white.user_id).match_id)
+            self.assertEqual(match.get_ply_count(), 1)
+            self.assertEqual([move.uci() for move in match.get_moves()], ["e2e4"])
+
+        self.assertNotIn(constants.ERROR_TURN, self.replies)
+
+    def test_conflict_on_commit_keeps_the_move(self):
+
+        fakes.fail_commits.append(exceptions.Aborted("contention"))
+        self.post(self.script.message(self.white, "e2e4"))
+        self.post(self.script.callback(self.white, "/accept"))
+        self.post(self.script.message(self.black, "e7e5"))
+        self.post(self.script.callback(self.black, "/accept"))
+
+        with request():
+            match = session.get(data.Match, session.get(data.User, self.white.user_id).match_id)
+            self.assertEqual([move.uci() for move in match.get_moves()], ["e2e4", "e7e5"])
+
+        self.assertNotIn(constants.ERROR_TURN, self.replies)
+
+
+
+class InviteTransactionTest(unittest.TestCase):
+
+    def setUp(self):
+        fakes.reset()
+
+        self.client = main.app.test_client()
+
+        self.white = Player(20)
+        self.black = Player(21)
+        self.script = Script(self.white, self.black, [], None)
+
+        # Up to the name of the adversary
+        for update in list(self.script.updates())[:4]:
+            self.post(update)
+
+    def post(self, update):
+        self.client.post("/hook", data=json.dumps(update), content_type="application/json")
+
+    def test_invite_survives_an_update_of_the_adversary(self):
+
+        check = main.lanes.check
+        invited = []
+
+        def interleaved_check(key, sender=None):
+            # The invite of black commits while an update of white runs
+            if sender == self.white.user_id and not invited:
+                invited.append(True)
+                thread = threading.Thread(target=self.post,
+                                          args=(self.script.message(self.black, self.white.username),))
+                thread.start()
+                thread.join()
+            return check(key, sender)
+
+        main.lanes.check = interleaved_check
+        try:
+            self.post(self.script.message(self.white, "/about"))
+        finally:
+            main.lanes.check = check
+
+        white, black = stored_user(self.white.user_id), stored_user(self.black.user_id)
+        self.assertEqual(invited, [True])
+        self.assertEqual(white.status, data.UserStatus.REQUESTED)
+        self.assertEqual(black.status, data.UserStatus.PENDING)
+        self.assertIsNotNone(white.match_id)
+        self.assertEqual(white.match_id, black.match_id)
+
+
+class ExpiryTransactionTest(unittest.TestCase):
+
+    def setUp(self):
+        fakes.reset()
+
+        self.client = main.app.test_client()
+
+        self.white = Player(30)
+        self.black = Player(31)
+        self.script = Script(self.white, self.black, [], None)
+
+        for update in self.script.updates():
+            if "callback_query" in update and update["callback_query"]["data"] == "/accept":
+                self.post(update)
+                break
+            self.post(update)
+
+        # White is late
+        with request():
+            self.match_id = session.get(data.User, self.white.user_id).match_id
+            match = session.get(data.Match, self.match_id)
+            match.last_move_date = datetime.now() - timedelta(seconds=match.timeout + 60)
+            session.save(match)
+
+    def post(self, update):
+        self.client.post("/hook", data=json.dumps(update), content_type="application/json")
+
+    def test_move_committed_during_expiry_is_kept(self):
+
+        get_player = maintainance.get_player
+        moved = []
+
+        def interleaved_get_player(match, user_id):
+            # White moves once the expiry has read the match
+            if not moved:
+                moved.append(True)
+                thread = threading.Thread(target=lambda: [self.post(self.script.message(self.white, "e2e4")),
+                                                          self.post(self.script.callback(self.white, "/accept"))])
+                thread.start()
+                thread.join()
+            return get_player(match, user_id)
+
+        maintainance.get_player = interleaved_get_player
+        try:
+            with request():
+                maintainance.task_matches()
+        finally:
+            maintainance.get_player = get_player
+
+        with request():
+            match = session.get(data.Match, self.match_id)
+            self.assertIsNotNone(match)
+            self.assertEqual([move.uci() for move in match.get_moves()], ["e2e4"])
+            self.assertEqual(session.get(data.User, self.white.user_id).status, data.UserStatus.PLAYING)
+            self.assertEqual(session.get(data.User, self.white.user_id).loss_count, 0)
+
+    def test_late_match_expires(self):
+
+        with request():
+            maintainance.task_matches()
+
+        with request():
+            self.assertIsNone(session.get(data.Match, self.match_id))
+            white = session.get(data.User, self.white.user_id)
+            self.assertEqual((white.status, white.loss_count), (data.UserStatus.IDLE, 1))
+
+if __name__ == "__main__":
+    unittest.main()
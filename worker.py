@@ -0,0 +1,87 @@
+# Long polling worker, an alternative to the webhook to run the bot on a
+# plain VM:
+#
+#   python worker.py
+#
+# Updates are pulled with getUpdates in batches and run in their lanes (see
+# lanes.py): in order within a match or user, in parallel across them. A
+# batch is confirmed to Telegram, by asking for the next one, only once it is
+# processed, up to its first failed update that is fetched again up to
+# POLL_MAX_RETRIES times.
+
+from shared import app, bot, dispatcher, ndb_client
+
+import logging
+import time
+from concurrent.futures import wait
+import telegram
+import lanes
+import session
+from main import process_update, submit_update
+
+
+def run_update(update):
+
+    # Users are read by the update in its lane, not for the whole batch: an
+    # update of another lane (an invite) may change them before the update
+    # runs, so a copy read for the batch would have to be read again anyway.
+    try:
+        with ndb_client.context(), session.scope(app.config.get('UOW_TRANSACTIONAL', False)):
+            processed = process_update(update)
+    except lanes.Reroute:
+        raise
+    except Exception:
+        logging.exception("Unable to process update %s", update.update_id)
+        raise
+
+    if processed:
+        outbox, chat_id = processed
+        outbox.release(dispatcher)
+
+
+def poll():
+
+    batch_size = app.config.get('POLL_BATCH_SIZE', 100)
+    timeout = app.config.get('POLL_TIMEOUT', 30)
+    max_retries = app.config.get('POLL_MAX_RETRIES', 3)
+
+    # getUpdates doesn't work while a webhook is set
+    bot.delete_webhook()
+
+    offset = None
+    failures = {}
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, limit=batch_size, timeout=timeout)
+        except telegram.error.NetworkError as e:
+            logging.warning("Unable to get updates (%s), retrying", e)
+            time.sleep(1)
+            continue
+
+        if not updates:
+            continue
+
+        futures = [submit_update(update, run_update) for update in updates]
+        wait(futures)
+
+        offset = updates[-1].update_id + 1
+        for update, future in zip(updates, futures):
+            if not future.exception():
+                continue
+
+            failures[update.update_id] = failures.get(update.update_id, 0) + 1
+            if failures[update.update_id] <= max_retries:
+                # Not confirmed: it comes again with the updates after it,
+                # the processed ones are skipped as duplicates
+                offset = update.update_id
+                time.sleep(1)
+                break
+
+            logging.error("Update %s dropped after %d attempts", update.update_id, failures[update.update_id])
+
+        failures = {update_id: count for update_id, count in failures.items() if update_id >= offset}
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    poll()